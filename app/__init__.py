@@ -1,23 +1,121 @@
-from flask import Flask, request, jsonify, render_template, session
-import requests
-import pdfplumber
+from flask import Flask, request, jsonify, render_template, session, g, send_file, current_app, has_request_context
 import re
 import json
 import concurrent.futures
+import difflib
 from datetime import datetime
 import os
+import io
+import gc
+import hashlib
+import hmac
+import importlib
+import math
+import mmap
+import multiprocessing
+import shutil
+import sqlite3
+import tempfile
+import time
+import random
+import bisect
+from collections import OrderedDict, defaultdict
+import operator
+from array import array
+import threading
+import uuid
+import weakref
+from types import MappingProxyType
+import zlib
 
 # AI endpoint configuration
 AI_ENDPOINT = "https://ai-bis.cfapps.eu10.hana.ondemand.com/ai-agent/getAI_response"
 
+# AI admission control, shared across workers through Redis when REDIS_URL is set:
+# a token bucket of AI_RATE_PER_SECOND refilling up to AI_BURST, at most
+# AI_MAX_CONCURRENCY calls in flight, and a deadline after which the chunk falls
+# back to the local-only result. Without Redis (or while it is down) each of the
+# WEB_CONCURRENCY workers gets an equal share of the budget, and Redis is not
+# retried for AI_REDIS_RETRY_INTERVAL seconds after an error
+REDIS_URL = os.environ.get('REDIS_URL')
+AI_RATE_PER_SECOND = float(os.environ.get('AI_RATE_PER_SECOND', 5))
+AI_BURST = int(os.environ.get('AI_BURST', 10))
+AI_MAX_CONCURRENCY = int(os.environ.get('AI_MAX_CONCURRENCY', 4))
+AI_ADMISSION_TIMEOUT = float(os.environ.get('AI_ADMISSION_TIMEOUT', 2.0))
+AI_CALL_TIMEOUT = 30
+AI_REDIS_RETRY_INTERVAL = float(os.environ.get('AI_REDIS_RETRY_INTERVAL', 5.0))
+AI_WORKER_COUNT = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+
 # Global variable to store uploaded EDI data
 uploaded_edi_data = None
 
+# Recent uploads by upload id, oldest first, with their lazily built element index.
+# Each upload is also written to UPLOAD_STORE_DIR so any gunicorn worker can load
+# it; the directory keeps the UPLOAD_STORE_LIMIT most recent uploads
+UPLOAD_STORE_LIMIT = int(os.environ.get('UPLOAD_STORE_LIMIT', 8))
+# Only the UPLOAD_ANALYSIS_LIMIT most recent uploads in a worker keep their
+# analysis and element index in memory; an analysis can take many times the
+# size of the EDI itself, so older uploads keep just their data and rebuild
+UPLOAD_ANALYSIS_LIMIT = int(os.environ.get('UPLOAD_ANALYSIS_LIMIT', 1))
+UPLOAD_STORE_DIR = os.environ.get('UPLOAD_STORE_DIR', os.path.join(tempfile.gettempdir(), 'edi-validator-uploads'))
+UPLOAD_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+uploaded_edi_store = OrderedDict()
+
+# Upload limits: request bodies larger than MAX_UPLOAD_BYTES are rejected before
+# they are read, and EDI files of EDI_MMAP_THRESHOLD bytes or more are spooled to
+# disk and memory-mapped instead of being read into memory
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 600 * 1024 * 1024))
+EDI_MMAP_THRESHOLD = int(os.environ.get('EDI_MMAP_THRESHOLD', 1024 * 1024))
+
+# Parallel conversion is opt-in: with PARALLEL_PARSE_WORKERS above one, EDI data
+# of PARALLEL_PARSE_THRESHOLD bytes or more is split before ST segments into
+# PARALLEL_SLICES_PER_WORKER slices per worker and converted to JSON by a pool of
+# that many processes. Every gunicorn worker starts its own pool, so keep
+# WEB_CONCURRENCY * PARALLEL_PARSE_WORKERS near the CPU count
+PARALLEL_PARSE_WORKERS = int(os.environ.get('PARALLEL_PARSE_WORKERS', 1))
+PARALLEL_PARSE_THRESHOLD = int(os.environ.get('PARALLEL_PARSE_THRESHOLD', 8 * 1024 * 1024))
+PARALLEL_SLICES_PER_WORKER = 4
+parse_executor = None
+parse_executor_lock = threading.Lock()
+# Files backing memory-mapped stored uploads, so pool workers can read them by path
+edi_file_paths = weakref.WeakKeyDictionary()
+
+# Duplicate interchange detection: interchanges are indexed on ISA sender,
+# receiver and control number (ISA13) plus a content hash, behind a Bloom
+# filter sized for DUPLICATE_INDEX_LIMIT entries at DUPLICATE_BLOOM_FP_RATE.
+# Entries live in SQLite at DUPLICATE_INDEX_PATH (at most DUPLICATE_INDEX_LIMIT
+# rows, in a directory only this user can read) or, when REDIS_URL is set, in
+# Redis for DUPLICATE_INDEX_TTL seconds. Interchanges larger than
+# DUPLICATE_RESULT_MAX_EDI_BYTES are indexed without their result and never
+# serialized; a result is also dropped if it compresses to more than
+# DUPLICATE_RESULT_MAX_BYTES, and SQLite drops the oldest results once they
+# total DUPLICATE_INDEX_MAX_BYTES.
+# A limit of 0 disables detection
+DUPLICATE_INDEX_PATH = os.environ.get(
+    'DUPLICATE_INDEX_PATH', os.path.join(tempfile.gettempdir(), 'edi-validator-index', 'interchanges.sqlite3')
+)
+DUPLICATE_INDEX_LIMIT = int(os.environ.get('DUPLICATE_INDEX_LIMIT', 10000))
+DUPLICATE_INDEX_TTL = int(os.environ.get('DUPLICATE_INDEX_TTL', 7 * 24 * 3600))
+DUPLICATE_BLOOM_FP_RATE = float(os.environ.get('DUPLICATE_BLOOM_FP_RATE', 0.01))
+DUPLICATE_RESULT_MAX_EDI_BYTES = int(os.environ.get('DUPLICATE_RESULT_MAX_EDI_BYTES', 4 * 1024 * 1024))
+DUPLICATE_RESULT_MAX_BYTES = int(os.environ.get('DUPLICATE_RESULT_MAX_BYTES', 1024 * 1024))
+DUPLICATE_INDEX_MAX_BYTES = int(os.environ.get('DUPLICATE_INDEX_MAX_BYTES', 256 * 1024 * 1024))
+
+# Request profiling, off unless PROFILING_ENABLED is set. A request is profiled
+# when it sends the X-Profile header with PROFILE_TOKEN, or at random with
+# probability PROFILE_SAMPLE_RATE; profiles are kept in PROFILE_DIR and served
+# to callers presenting PROFILE_TOKEN in X-Profile-Token
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'edi-validator-profiles'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 50))
+
 # EDI segment patterns
-EDI_SEGMENTS = ['ISA', 'GS', 'ST', 'BAK', 'REF', 'DTM', 'N1', 'PO1', 'ACK', 'CTT', 'SE', 'GE', 'IEA']
+EDI_SEGMENTS = ('ISA', 'GS', 'ST', 'BAK', 'REF', 'DTM', 'N1', 'PO1', 'ACK', 'CTT', 'SE', 'GE', 'IEA')
 
 # EDI Element Data Types mapping
-EDI_DATA_TYPES = {
+EDI_DATA_TYPES = MappingProxyType({
     'ISA01': 'ID',
     'ISA02': 'AN',
     'ISA09': 'DT',
@@ -47,16 +145,283 @@ EDI_DATA_TYPES = {
     'SE': 'N0/AN',
     'GE': 'N0/AN',
     'IEA': 'N0'
-}
+})
+
+# Element descriptions by segment and position
+EDI_ELEMENT_DESCRIPTIONS = MappingProxyType({
+    'ISA': {
+        1: 'Authorization Information Qualifier',
+        2: 'Authorization Information',
+        3: 'Security Information Qualifier', 
+        4: 'Security Information',
+        5: 'Interchange ID Qualifier',
+        6: 'Interchange Sender ID',
+        7: 'Interchange ID Qualifier',
+        8: 'Interchange Receiver ID',
+        9: 'Interchange Date',
+        10: 'Interchange Time',
+        11: 'Interchange Control Standards Identifier',
+        12: 'Interchange Control Version Number',
+        13: 'Interchange Control Number',
+        14: 'Acknowledgment Requested',
+        15: 'Usage Indicator',
+        16: 'Component Element Separator'
+    },
+    'GS': {
+        1: 'Functional Identifier Code',
+        2: 'Application Sender\'s Code',
+        3: 'Application Receiver\'s Code', 
+        4: 'Date',
+        5: 'Time',
+        6: 'Group Control Number',
+        7: 'Responsible Agency Code',
+        8: 'Version / Release / Industry Identifier Code'
+    },
+    'ST': {
+        1: 'Transaction Set Identifier Code',
+        2: 'Transaction Set Control Number'
+    },
+    'BAK': {
+        1: 'Transaction Set Purpose Code',
+        2: 'Acknowledgment Type',
+        3: 'Purchase Order Number',
+        4: 'Date'
+    },
+    'PO1': {
+        1: 'Assigned Identification',
+        2: 'Quantity Ordered',
+        3: 'Unit or Basis for Measurement Code',
+        4: 'Unit Price',
+        5: 'Basis of Unit Price Code',
+        6: 'Product/Service ID Qualifier',
+        7: 'Product/Service ID',
+        8: 'Product/Service ID Qualifier',
+        9: 'Product/Service ID',
+        10: 'Product/Service ID Qualifier',
+        11: 'Product/Service ID'
+    },
+    'ACK': {
+        1: 'Line Item Status Code',
+        2: 'Quantity',
+        3: 'Unit or Basis for Measurement Code',
+        4: 'Date/Time Qualifier',
+        5: 'Date',
+        6: 'Request Reference Number',
+        7: 'Product/Service ID Qualifier',
+        8: 'Product/Service ID'
+    },
+    'CTT': {
+        1: 'Number of Line Items'
+    },
+    'SE': {
+        1: 'Number of Included Segments',
+        2: 'Transaction Set Control Number'
+    },
+    'GE': {
+        1: 'Number of Transaction Sets Included',
+        2: 'Group Control Number'
+    },
+    'IEA': {
+        1: 'Number of Included Functional Groups',
+        2: 'Interchange Control Number'
+    }
+})
+
+# ACK line item status codes
+ACK_STATUS_DESCRIPTIONS = MappingProxyType({
+    'IA': 'Item Accepted',
+    'IB': 'Item Backordered', 
+    'IC': 'Item Accepted - Changes Made',
+    'ID': 'Item Deleted',
+    'IR': 'Item Rejected'
+})
+
+# X12 004010 element rules: (data type, min length, max length, optional code list)
+EDI_ELEMENT_RULES = MappingProxyType({
+    'ISA01': ('ID', 2, 2, ('00', '03')),
+    'ISA02': ('AN', 10, 10, None),
+    'ISA03': ('ID', 2, 2, ('00', '01')),
+    'ISA04': ('AN', 10, 10, None),
+    'ISA05': ('ID', 2, 2, None),
+    'ISA06': ('AN', 15, 15, None),
+    'ISA07': ('ID', 2, 2, None),
+    'ISA08': ('AN', 15, 15, None),
+    'ISA09': ('DT', 6, 6, None),
+    'ISA10': ('TM', 4, 4, None),
+    'ISA11': ('ID', 1, 1, None),
+    'ISA12': ('ID', 5, 5, None),
+    'ISA13': ('N0', 9, 9, None),
+    'ISA14': ('ID', 1, 1, ('0', '1')),
+    'ISA15': ('ID', 1, 1, ('I', 'P', 'T')),
+    'ISA16': ('AN', 1, 1, None),
+    'GS01': ('ID', 2, 2, None),
+    'GS02': ('AN', 2, 15, None),
+    'GS03': ('AN', 2, 15, None),
+    'GS04': ('DT', 8, 8, None),
+    'GS05': ('TM', 4, 8, None),
+    'GS06': ('N0', 1, 9, None),
+    'GS07': ('ID', 1, 2, None),
+    'GS08': ('AN', 1, 12, None),
+    'ST01': ('ID', 3, 3, ('855',)),
+    'ST02': ('AN', 4, 9, None),
+    'BAK01': ('ID', 2, 2, None),
+    'BAK02': ('ID', 2, 2, ('AC', 'AD', 'AE', 'AH', 'AK', 'AP', 'AT', 'NA', 'RD', 'RF', 'RJ', 'RN', 'RO', 'RV', 'ZZ')),
+    'BAK03': ('AN', 1, 22, None),
+    'BAK04': ('DT', 8, 8, None),
+    'REF01': ('ID', 2, 3, None),
+    'REF02': ('AN', 1, 30, None),
+    'REF03': ('AN', 1, 80, None),
+    'DTM01': ('ID', 3, 3, None),
+    'DTM02': ('DT', 8, 8, None),
+    'DTM03': ('TM', 4, 8, None),
+    'N101': ('ID', 2, 3, None),
+    'N102': ('AN', 1, 60, None),
+    'N103': ('ID', 1, 2, None),
+    'N104': ('AN', 2, 80, None),
+    'PO101': ('AN', 1, 20, None),
+    'PO102': ('R', 1, 15, None),
+    'PO103': ('ID', 2, 2, None),
+    'PO104': ('R', 1, 17, None),
+    'PO105': ('ID', 2, 2, None),
+    'PO106': ('ID', 2, 2, None),
+    'PO107': ('AN', 1, 48, None),
+    'PO108': ('ID', 2, 2, None),
+    'PO109': ('AN', 1, 48, None),
+    'PO110': ('ID', 2, 2, None),
+    'PO111': ('AN', 1, 48, None),
+    'ACK01': ('ID', 2, 2, ('AA', 'AC', 'AR', 'BP', 'DR', 'IA', 'IB', 'IC', 'ID', 'IE', 'IF', 'IH',
+                           'IP', 'IQ', 'IR', 'IS', 'IW', 'R1', 'R2', 'R3', 'R4', 'SP')),
+    'ACK02': ('R', 1, 15, None),
+    'ACK03': ('ID', 2, 2, None),
+    'ACK04': ('ID', 3, 3, None),
+    'ACK05': ('DT', 8, 8, None),
+    'ACK06': ('AN', 1, 45, None),
+    'ACK07': ('ID', 2, 2, None),
+    'ACK08': ('AN', 1, 48, None),
+    'CTT01': ('N0', 1, 6, None),
+    'CTT02': ('R', 1, 10, None),
+    'SE01': ('N0', 1, 10, None),
+    'SE02': ('AN', 4, 9, None),
+    'GE01': ('N0', 1, 6, None),
+    'GE02': ('N0', 1, 9, None),
+    'IEA01': ('N0', 1, 5, None),
+    'IEA02': ('N0', 9, 9, None)
+})
+
+def prepare_for_fork():
+    """Import heavy modules and freeze the heap before a pre-forking server forks workers"""
+    # Runs once in the gunicorn master (preload_app) so the modules and lookup
+    # tables are shared copy-on-write, and frozen objects are never scanned (and
+    # so never copied) by the cyclic GC in the workers
+    for module_name in ('pdfplumber', 'pypdfium2', 'requests'):
+        importlib.import_module(module_name)
+    gc.collect()
+    gc.freeze()
+
+# Cheap signatures of a segment table page, checked against pdfium's raw text
+SPEC_PAGE_SEGMENT_PATTERN = re.compile(r'\b(?:' + '|'.join(EDI_SEGMENTS) + r')(?:\b|0[1-3])')
+SPEC_PAGE_USAGE_PATTERN = re.compile(r'\b[MO]\b|MUST USE|USED|MAY USE|MANDATORY|OPTIONAL', re.IGNORECASE)
+
+def page_has_spec_table(page_text):
+    """Check whether raw page text looks like it contains a segment table"""
+    return bool(SPEC_PAGE_SEGMENT_PATTERN.search(page_text) and SPEC_PAGE_USAGE_PATTERN.search(page_text))
+
+def screen_pdf_pages(pdf_file):
+    """Return the 1-based numbers of pages worth a full layout pass, and the page count"""
+    import pypdfium2 as pdfium
+    
+    pdf = pdfium.PdfDocument(pdf_file)
+    try:
+        total_pages = len(pdf)
+        candidate_pages = []
+        for index in range(total_pages):
+            page = pdf[index]
+            textpage = page.get_textpage()
+            if page_has_spec_table(textpage.get_text_range()):
+                candidate_pages.append(index + 1)
+            textpage.close()
+            page.close()
+        return candidate_pages, total_pages
+    finally:
+        pdf.close()
+        pdf_file.seek(0)
 
-def extract_pdf_text(pdf_file):
+def group_word_rows(words, tolerance=3):
+    """Group pdfplumber words into rows by their top coordinate"""
+    rows = []
+    for word in sorted(words, key=lambda w: (round(w['top']), w['x0'])):
+        if rows and abs(rows[-1][0] - word['top']) <= tolerance:
+            rows[-1][1].append(word)
+        else:
+            rows.append((word['top'], [word]))
+    return [sorted(row_words, key=lambda w: w['x0']) for _, row_words in rows]
+
+def extract_word_rows(page, tolerance=3):
+    """Rebuild table rows from word coordinates instead of the flowed page text"""
+    return "\n".join(" ".join(w['text'] for w in row_words)
+                     for row_words in group_word_rows(page.extract_words(), tolerance))
+
+def iter_pdf_page_texts(pdf_file, prescreen=True, word_rows=False, stats=None, on_page=None):
+    """Yield the text of each page worth reading as soon as it is laid out
+
+    on_page, if given, is called with each laid-out pdfplumber page so other
+    extractors can reuse the same layout pass. Page counts and timings are
+    added to stats once the last page is done.
+    """
+    import pdfplumber
+    
+    stats = {} if stats is None else stats
+    started = time.perf_counter()
+    pages = None
+    total_pages = None
+    if prescreen:
+        try:
+            pages, total_pages = screen_pdf_pages(pdf_file)
+        except Exception as e:
+            # Fall back to a full extraction if pdfium cannot read the document
+            print(f"PDF pre-screening failed, extracting all pages: {e}")
+            pdf_file.seek(0)
+    screened = time.perf_counter()
+    
+    # Time spent by the consumer between pages is not layout time
+    extract_time = 0.0
+    if pages != []:
+        with pdfplumber.open(pdf_file, pages=pages) as pdf:
+            for page in pdf.pages:
+                page_started = time.perf_counter()
+                text = extract_word_rows(page) if word_rows else page.extract_text()
+                if on_page is not None:
+                    on_page(page)
+                extract_time += time.perf_counter() - page_started
+                if text:
+                    yield text
+            extracted_pages = len(pdf.pages)
+            if total_pages is None:
+                total_pages = extracted_pages
+    else:
+        extracted_pages = 0
+    
+    # Estimate the saving from the average layout cost of the pages we did extract
+    per_page = extract_time / extracted_pages if extracted_pages else 0
+    skipped_pages = total_pages - extracted_pages
+    stats.update({
+        "total_pages": total_pages,
+        "pages_extracted": extracted_pages,
+        "pages_skipped": skipped_pages,
+        "screen_time_ms": round((screened - started) * 1000, 2),
+        "extract_time_ms": round(extract_time * 1000, 2),
+        "estimated_time_saved_ms": round((skipped_pages * per_page - (screened - started)) * 1000, 2)
+    })
+
+def extract_pdf_text_with_stats(pdf_file, prescreen=True, word_rows=False):
+    """Extract text from PDF file, laying out only pages that look like spec tables"""
+    stats = {"prescreen": prescreen, "word_rows": word_rows}
+    pdf_text = "".join(text + "\n" for text in iter_pdf_page_texts(pdf_file, prescreen, word_rows, stats))
+    return pdf_text, stats
+
+def extract_pdf_text(pdf_file, prescreen=True, word_rows=False):
     """Extract text from PDF file"""
-    pdf_text = ""
-    with pdfplumber.open(pdf_file) as pdf:
-        for page in pdf.pages:
-            text = page.extract_text()
-            if text:
-                pdf_text += text + "\n"
+    pdf_text, _ = extract_pdf_text_with_stats(pdf_file, prescreen, word_rows)
     return pdf_text
 
 def filter_edi_lines(pdf_text):
@@ -106,8 +471,176 @@ def chunk_iter(lines, chunk_size=5):
     for i in range(0, len(lines), chunk_size):
         yield lines[i:i + chunk_size]
 
+# Atomically refill the bucket, expire stale leases, and take a token plus a
+# concurrency lease if both are available. Returns 1 when admitted.
+AI_ADMISSION_SCRIPT = """
+local bucket_key, leases_key = KEYS[1], KEYS[2]
+local now, rate, burst, max_inflight, lease_ttl = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local lease_id = ARGV[6]
+
+redis.call('ZREMRANGEBYSCORE', leases_key, '-inf', now)
+if redis.call('ZCARD', leases_key) >= max_inflight then
+    return 0
+end
+
+local bucket = redis.call('HMGET', bucket_key, 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+if tokens < 1 then
+    redis.call('HSET', bucket_key, 'tokens', tokens, 'updated', now)
+    return 0
+end
+
+redis.call('HSET', bucket_key, 'tokens', tokens - 1, 'updated', now)
+redis.call('EXPIRE', bucket_key, 3600)
+redis.call('ZADD', leases_key, now + lease_ttl, lease_id)
+redis.call('EXPIRE', leases_key, 3600)
+return 1
+"""
+
+class AIAdmissionController:
+    """Token-bucket rate limiter with a concurrency cap for outbound AI calls
+
+    Uses Redis so all gunicorn workers share one budget, and falls back to an
+    in-process bucket holding this worker's share of it when Redis is not
+    configured or unreachable.
+    """
+    
+    def __init__(self, rate=AI_RATE_PER_SECOND, burst=AI_BURST, max_concurrency=AI_MAX_CONCURRENCY,
+                 redis_client=None, key_prefix='edi-validator:ai', workers=AI_WORKER_COUNT,
+                 retry_interval=AI_REDIS_RETRY_INTERVAL):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.redis = redis_client
+        self.bucket_key = f'{key_prefix}:bucket'
+        self.leases_key = f'{key_prefix}:leases'
+        self.metrics_key = f'{key_prefix}:metrics'
+        # Leases outlive a call's own timeout so a crashed worker cannot hold a slot forever
+        self.lease_ttl = AI_CALL_TIMEOUT + 5
+        self._script = redis_client.register_script(AI_ADMISSION_SCRIPT) if redis_client is not None else None
+        self.retry_interval = retry_interval
+        self._redis_retry_at = 0.0
+        
+        # The local bucket only holds this worker's share so an outage does not
+        # multiply the upstream quota by the worker count
+        self.local_rate = rate / workers
+        self.local_burst = max(1, burst // workers)
+        self.local_max_concurrency = max(1, max_concurrency // workers)
+        
+        self._lock = threading.Lock()
+        self._tokens = float(self.local_burst)
+        self._updated = time.monotonic()
+        self._inflight = 0
+        self.metrics = {"admitted": 0, "rejected": 0, "redis_errors": 0, "wait_ms_total": 0.0}
+    
+    def _try_acquire_local(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.local_burst, self._tokens + (now - self._updated) * self.local_rate)
+            self._updated = now
+            if self._inflight >= self.local_max_concurrency or self._tokens < 1:
+                return None
+            self._tokens -= 1
+            self._inflight += 1
+            return 'local'
+    
+    def _redis_available(self):
+        return self._script is not None and time.monotonic() >= self._redis_retry_at
+    
+    def _redis_failed(self, message, error):
+        self._redis_retry_at = time.monotonic() + self.retry_interval
+        self._count('redis_errors')
+        print(f"{message}: {error}")
+    
+    def _try_acquire(self):
+        if self._redis_available():
+            lease_id = uuid.uuid4().hex
+            try:
+                admitted = self._script(
+                    keys=[self.bucket_key, self.leases_key],
+                    args=[time.time(), self.rate, self.burst, self.max_concurrency, self.lease_ttl, lease_id]
+                )
+                return lease_id if admitted else None
+            except Exception as e:
+                self._redis_failed(f"AI admission Redis backend unavailable, using in-process "
+                                   f"limiter for {self.retry_interval:g}s", e)
+        return self._try_acquire_local()
+    
+    def acquire(self, timeout=AI_ADMISSION_TIMEOUT):
+        """Wait up to timeout seconds for capacity; returns a lease or None"""
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            lease = self._try_acquire()
+            now = time.monotonic()
+            if lease is not None or now >= deadline:
+                break
+            time.sleep(min(1.0 / self.rate if self.rate else 0.05, 0.05, deadline - now))
+        
+        self._count('admitted' if lease is not None else 'rejected', wait_ms=(time.monotonic() - started) * 1000)
+        return lease
+    
+    def release(self, lease):
+        if lease is None:
+            return
+        if lease == 'local':
+            with self._lock:
+                self._inflight -= 1
+            return
+        try:
+            self.redis.zrem(self.leases_key, lease)
+        except Exception as e:
+            # The lease expires on its own after lease_ttl
+            self._redis_failed("Failed to release AI admission lease", e)
+    
+    def _count(self, decision, wait_ms=0.0):
+        with self._lock:
+            self.metrics[decision] += 1
+            self.metrics["wait_ms_total"] += wait_ms
+        if decision != 'redis_errors' and self._redis_available():
+            try:
+                self.redis.hincrby(self.metrics_key, decision, 1)
+            except Exception:
+                pass
+    
+    def get_metrics(self):
+        """Admission counters for this worker and, with Redis, across all workers"""
+        with self._lock:
+            result = {"worker": dict(self.metrics, inflight=self._inflight)}
+        result["worker"]["wait_ms_total"] = round(result["worker"]["wait_ms_total"], 2)
+        result["backend"] = "redis" if self.redis is not None else "local"
+        if self.redis is not None and not self._redis_available():
+            result["redis_retry_in_s"] = round(self._redis_retry_at - time.monotonic(), 2)
+        if self.redis is not None:
+            try:
+                shared = self.redis.hgetall(self.metrics_key)
+                result["all_workers"] = {
+                    (k.decode() if isinstance(k, bytes) else k): int(v) for k, v in shared.items()
+                }
+                result["all_workers"]["inflight"] = self.redis.zcount(self.leases_key, time.time(), '+inf')
+            except Exception as e:
+                result["all_workers"] = {"error": str(e)}
+        return result
+
+def create_ai_admission_controller():
+    """Build the AI admission controller, backed by Redis when REDIS_URL is set"""
+    redis_client = None
+    if REDIS_URL:
+        try:
+            import redis
+            redis_client = redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+        except Exception as e:
+            print(f"Redis unavailable for AI admission control, using in-process limiter: {e}")
+    return AIAdmissionController(redis_client=redis_client)
+
+ai_admission = create_ai_admission_controller()
+
 def call_ai_endpoint_chunk(chunk_lines):
     """Call AI endpoint for a chunk of lines"""
+    import requests
+    
     system_prompt = "You are an EDI 855 specification expert. Analyze the provided lines and extract segment information. ALWAYS return ONLY valid JSON, no markdown, no explanations."
     
     user_prompt = f"""
@@ -133,6 +666,11 @@ Lines to analyze:
 {chr(10).join(chunk_lines)}
 """
     
+    # Without capacity the chunk is skipped and merge_results keeps the local result
+    lease = ai_admission.acquire()
+    if lease is None:
+        return {"error": "AI capacity unavailable, using local result", "admission": "rejected"}
+    
     try:
         response = requests.post(
             AI_ENDPOINT,
@@ -140,12 +678,232 @@ Lines to analyze:
                 "system_prompt": system_prompt,
                 "user_prompt": user_prompt
             },
-            timeout=30
+            timeout=AI_CALL_TIMEOUT
         )
         response.raise_for_status()
         return response.json()
     except Exception as e:
         return {"error": str(e)}
+    finally:
+        ai_admission.release(lease)
+
+def run_spec_pipeline(pdf_file, prescreen=True, word_rows=False, use_ai=True, chunk_size=5, on_page=None):
+    """Stream PDF pages through the line filter, sending each full chunk to the AI as it fills
+
+    Chunks are the same as chunk_iter over the complete filtered lines, and up
+    to AI_MAX_CONCURRENCY of them are in flight while later pages are still
+    being laid out. Returns (filtered_lines, ai_results in chunk order, stats).
+    """
+    stats = {"prescreen": prescreen, "word_rows": word_rows}
+    started = time.perf_counter()
+    filtered_lines = []
+    pending = []
+    futures = []
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(AI_MAX_CONCURRENCY, 1)) as executor:
+        def send(chunk):
+            if not futures:
+                stats["first_chunk_sent_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            futures.append(executor.submit(profile_thread_task(call_ai_endpoint_chunk), chunk))
+        
+        for page_text in iter_pdf_page_texts(pdf_file, prescreen, word_rows, stats, on_page):
+            page_lines = filter_edi_lines(page_text)
+            filtered_lines.extend(page_lines)
+            if not use_ai:
+                continue
+            pending.extend(page_lines)
+            while len(pending) >= chunk_size:
+                send(pending[:chunk_size])
+                del pending[:chunk_size]
+        if pending:
+            send(pending)
+        stats["pages_done_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        
+        ai_results = [future.result() for future in futures]
+    
+    stats["chunks_sent"] = len(futures)
+    stats["pipeline_time_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return filtered_lines, ai_results, stats
+
+def normalize_company_usage(text):
+    """Map company usage wording to must_use/used/conditional/not_used"""
+    text = text.upper()
+    if "MUST USE" in text:
+        return "must_use"
+    elif "NOT USED" in text:
+        return "not_used"
+    elif "MAY USE" in text:
+        return "conditional"
+    elif "USED" in text:  # Check this after NOT USED
+        return "used"
+    return None
+
+# Header keywords of segment table columns in implementation guides, in the
+# order they are tried; a header row must name at least SPEC_HEADER_MIN_COLUMNS
+SPEC_TABLE_COLUMNS = (
+    ('position', ('POS', 'POS.', 'POSITION', 'SEQ', 'SEQ.')),
+    ('tag', ('ID', 'TAG', 'SEG', 'SEG.', 'SEGMENT')),
+    ('name', ('NAME', 'DESCRIPTION', 'TITLE')),
+    ('requirement', ('REQ', 'REQ.', 'REQ.DES.', 'REQUIREMENT', 'STATUS', 'ATTRIBUTES')),
+    ('max_use', ('MAX', 'MAX.', 'MAXIMUM')),
+    ('loop', ('LOOP', 'REPEAT', 'LOOP/REPEAT')),
+    ('usage', ('USAGE', 'USER'))
+)
+SPEC_HEADER_MIN_COLUMNS = 4
+SEGMENT_TAG_PATTERN = re.compile(r'[A-Z][A-Z0-9]{1,2}')
+MAX_USE_PATTERN = re.compile(r'>\s?1|\d+')
+# Rows of guides without a recognizable header: tag, name, M/O, max use, usage
+FLOWED_SPEC_ROW_PATTERN = re.compile(
+    r'^(?:\d{3,4}\s+)?([A-Z][A-Z0-9]{1,2})\s+(.+?)\s+([MO])\s+(>\s?1|\d+)(?:\s+(>\s?1|\d+))?\s*(.*)$'
+)
+
+def match_header_columns(cells):
+    """Map header cell/word texts to table columns; returns {column: index} or None"""
+    columns = {}
+    for index, text in enumerate(cells):
+        word = (text or '').strip().upper()
+        if not word:
+            continue
+        words = word.split()
+        for column, keywords in SPEC_TABLE_COLUMNS:
+            if column in columns:
+                continue
+            # "Segment Name" names the name column, not the tag column
+            if column == 'tag' and 'NAME' in words:
+                continue
+            if word in keywords or words[0] in keywords or words[-1] in keywords:
+                columns[column] = index
+                break
+    return columns if len(columns) >= SPEC_HEADER_MIN_COLUMNS and 'tag' in columns else None
+
+def parse_spec_row(values):
+    """Turn a {column: text} row into (segment_tag, spec) or None if it is not a segment row"""
+    tag = (values.get('tag') or '').strip().upper()
+    if not SEGMENT_TAG_PATTERN.fullmatch(tag):
+        return None
+    
+    requirement = (values.get('requirement') or '').strip().upper()
+    x12_req = None
+    if requirement.startswith('M'):
+        x12_req = "mandatory"
+    elif requirement.startswith('O') or requirement.startswith('C'):
+        x12_req = "optional"
+    if x12_req is None and 'requirement' in values:
+        return None
+    
+    max_usage = None
+    max_match = MAX_USE_PATTERN.search(values.get('max_use') or '')
+    if max_match:
+        max_value = max_match.group(0).replace(' ', '')
+        max_usage = max_value if max_value.startswith('>') else int(max_value)
+    
+    return tag, {
+        "x12_requirement": x12_req,
+        "company_usage": normalize_company_usage(values.get('usage') or ''),
+        "min_usage": None,
+        "max_usage": max_usage,
+        "segment_name": (values.get('name') or '').strip() or None,
+        "loop_repeat": (values.get('loop') or '').strip() or None,
+        "position": (values.get('position') or '').strip() or None
+    }
+
+def group_row_phrases(row_words, gap_ratio=0.6):
+    """Join words separated by no more than a word space into header phrases (e.g. Max Use)"""
+    phrases = []
+    for word in row_words:
+        if phrases and word['x0'] - phrases[-1]['x1'] <= word['height'] * gap_ratio:
+            phrases[-1]['text'] += ' ' + word['text']
+            phrases[-1]['x1'] = word['x1']
+        else:
+            phrases.append({'text': word['text'], 'x0': word['x0'], 'x1': word['x1']})
+    return phrases
+
+def extract_table_spec_rows(page):
+    """Read segment rows from ruled tables detected by pdfplumber"""
+    rows = []
+    for table in page.extract_tables():
+        header = None
+        for row_index, cells in enumerate(table[:3]):
+            header = match_header_columns(cells)
+            if header:
+                break
+        if not header:
+            continue
+        for cells in table[row_index + 1:]:
+            values = {column: cells[index] if index < len(cells) else None for column, index in header.items()}
+            parsed = parse_spec_row(values)
+            if parsed:
+                rows.append(parsed)
+    return rows
+
+def extract_word_spec_rows(page, tolerance=3):
+    """Rebuild segment table columns from word coordinates below a header row"""
+    rows = []
+    column_starts = None
+    for row_words in group_word_rows(page.extract_words(), tolerance):
+        phrases = group_row_phrases(row_words)
+        header = match_header_columns([phrase['text'] for phrase in phrases])
+        if header:
+            # Each column starts at its header phrase; words belong to the last column starting left of them
+            column_starts = sorted((phrases[index]['x0'], column) for column, index in header.items())
+            continue
+        
+        if column_starts is None:
+            # No header seen yet on this page, fall back to the flowed row pattern
+            match = FLOWED_SPEC_ROW_PATTERN.match(" ".join(word['text'] for word in row_words))
+            if match:
+                tag, name, requirement, max_use, loop, usage = match.groups()
+                parsed = parse_spec_row({"tag": tag, "name": name, "requirement": requirement,
+                                         "max_use": max_use, "loop": loop, "usage": usage})
+                if parsed:
+                    rows.append(parsed)
+            continue
+        
+        values = defaultdict(list)
+        for word in row_words:
+            column = column_starts[0][1]
+            for start, candidate in column_starts:
+                if word['x0'] >= start - tolerance:
+                    column = candidate
+            values[column].append(word['text'])
+        parsed = parse_spec_row({column: " ".join(texts) for column, texts in values.items()})
+        if parsed:
+            rows.append(parsed)
+    return rows
+
+def extract_spec_table(pdf_file, prescreen=True):
+    """Build the segment specification from table/word coordinates, without the AI"""
+    import pdfplumber
+    
+    pages = None
+    if prescreen:
+        try:
+            pages, _ = screen_pdf_pages(pdf_file)
+        except Exception as e:
+            print(f"PDF pre-screening failed, extracting all pages: {e}")
+            pdf_file.seek(0)
+        if pages == []:
+            return {}
+    
+    result = {}
+    with pdfplumber.open(pdf_file, pages=pages) as pdf:
+        for page in pdf.pages:
+            merge_spec_rows(result, extract_page_spec_rows(page))
+    pdf_file.seek(0)
+    return result
+
+def extract_page_spec_rows(page):
+    """Read segment rows from a laid-out page, preferring ruled tables over word coordinates"""
+    return extract_table_spec_rows(page) or extract_word_spec_rows(page)
+
+def merge_spec_rows(result, rows):
+    """Add (segment, spec) rows to result, keeping the first occurrence and filling its gaps"""
+    for segment, spec in rows:
+        existing = result.setdefault(segment, spec)
+        for key, value in spec.items():
+            if existing.get(key) is None and value is not None:
+                existing[key] = value
+    return result
 
 def build_local_segment_dict(lines):
     """Build segment dictionary locally as fallback"""
@@ -178,15 +936,7 @@ def build_local_segment_dict(lines):
             x12_req = "optional"
         
         # Extract company usage
-        company_usage = None
-        if "MUST USE" in line_upper:
-            company_usage = "must_use"
-        elif "NOT USED" in line_upper:
-            company_usage = "not_used"
-        elif "MAY USE" in line_upper:
-            company_usage = "conditional"
-        elif "USED" in line_upper:  # Check this after NOT USED
-            company_usage = "used"
+        company_usage = normalize_company_usage(line_upper)
         
         # Extract min/max usage
         min_usage, max_usage = None, None
@@ -264,58 +1014,157 @@ def merge_results(ai_results, local_result):
     
     return merged
 
-def parse_edi_elements(edi_data):
-    """Parse EDI data into individual elements with positions"""
-    parsed_elements = []
+def read_edi_upload(edi_file):
+    """Read an uploaded EDI file, memory-mapping large files instead of decoding them"""
+    stream = edi_file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
     
-    if not edi_data:
-        return parsed_elements
+    if size < EDI_MMAP_THRESHOLD or size == 0:
+        return stream.read().decode('utf-8').strip()
     
-    # Split by lines and process each segment
-    lines = edi_data.splitlines()
+    # Werkzeug already spools large uploads to a temporary file; map it directly
+    # and only copy to our own temporary file if the stream is memory-backed
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        spool = tempfile.TemporaryFile()
+        shutil.copyfileobj(stream, spool)
+        spool.flush()
+        fileno = spool.fileno()
     
-    for line_num, line in enumerate(lines, 1):
+    return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+def iter_buffer_lines(buf):
+    """Yield raw lines from a bytes-like buffer without copying the whole buffer
+
+    Lines end at \n, \r or \r\n, like str.splitlines() on the decoded text,
+    so a file parses the same whether or not it was memory-mapped.
+    """
+    start = 0
+    size = len(buf)
+    # The next position of each break byte is only searched for again once
+    # passed, so files using one convention are not rescanned for the other
+    next_lf = next_cr = -1
+    while start < size:
+        if next_lf < start:
+            next_lf = buf.find(b'\n', start)
+            if next_lf == -1:
+                next_lf = size
+        if next_cr < start:
+            next_cr = buf.find(b'\r', start)
+            if next_cr == -1:
+                next_cr = size
+        end = min(next_lf, next_cr)
+        yield buf[start:end]
+        start = end + 2 if end == next_cr and next_lf == end + 1 else end + 1
+
+def iter_edi_lines(edi_data):
+    """Yield (line_number, line) for EDI data given as a string or a bytes-like buffer"""
+    if isinstance(edi_data, str):
+        yield from enumerate(edi_data.splitlines(), 1)
+    else:
+        # Decode one line at a time so the buffer is never decoded as a whole
+        for line_num, raw_line in enumerate(iter_buffer_lines(edi_data), 1):
+            yield line_num, raw_line.decode('utf-8')
+
+def iter_edi_segments(edi_data, tags=None):
+    """Yield (line_number, raw_line, elements) for every segment, optionally only for some tags"""
+    for line_num, line in iter_edi_lines(edi_data):
         line = line.strip()
         if not line or '~' not in line:
             continue
         
         # Remove the trailing ~ and split by *
         segment_data = line.rstrip('~')
-        if '*' not in segment_data:
+        separator = segment_data.find('*')
+        if separator == -1:
             continue
-            
-        elements = segment_data.split('*')
+        # Skip unwanted segments before paying for the full split
+        if tags is not None and segment_data[:separator] not in tags:
+            continue
+        
+        yield line_num, line, segment_data.split('*')
+
+def iter_segment_tags(edi_data):
+    """Yield the segment tag of every line, decoding only the tag itself"""
+    if isinstance(edi_data, str):
+        for line in edi_data.splitlines():
+            line = line.strip()
+            if line and '*' in line:
+                yield line.split('*', 1)[0]
+    else:
+        for raw_line in iter_buffer_lines(edi_data):
+            raw_line = raw_line.strip()
+            if raw_line and b'*' in raw_line:
+                yield raw_line.split(b'*', 1)[0].decode('utf-8')
+
+def edi_has_content(edi_data):
+    """Check whether EDI data contains anything other than whitespace"""
+    if isinstance(edi_data, str):
+        return bool(edi_data.strip())
+    return any(line.strip() for line in iter_buffer_lines(edi_data))
+
+def edi_preview(edi_data, length=100):
+    """Return the first characters of EDI data for logging, decoding only that much of a buffer"""
+    if isinstance(edi_data, str):
+        return edi_data[:length]
+    return edi_data[:length].decode('utf-8', errors='replace')
+
+def edi_to_text(edi_data):
+    """Return EDI data as a string, decoding memory-mapped uploads"""
+    if isinstance(edi_data, str):
+        return edi_data
+    return edi_data[:].decode('utf-8').strip()
+
+def parse_edi_elements(edi_data):
+    """Parse EDI data into individual elements with positions"""
+    if not edi_data:
+        return []
+    return build_edi_elements(iter_edi_segments(edi_data))
+
+def build_edi_elements(segments):
+    """Build the element list from a stream of (line_number, raw_line, elements) segments"""
+    parsed_elements = []
+    # Code, description and data type depend only on the segment and position,
+    # so they are worked out once per call and shared by every element
+    element_info = {}
+    
+    for line_num, line, elements in segments:
         segment_tag = elements[0] if elements else ''
         
         # Parse each element with its position
         for i, element in enumerate(elements):
-            if i == 0:
-                # First element is the segment tag itself
-                parsed_elements.append({
-                    'line_number': line_num,
-                    'segment_tag': segment_tag,
-                    'element_position': 'Segment ID',
-                    'element_code': segment_tag,
-                    'element_value': element,
-                    'data_type': 'ID',
-                    'element_description': f'{segment_tag} - Segment Identifier'
-                })
-            else:
-                # Subsequent elements are numbered positions
-                element_code = f'{segment_tag}{i:02d}'
-                # Get description first to determine data type
-                description = get_element_description(segment_tag, i, element)
-                # Get data type for this specific element (check specific mapping first, then description-based)
-                data_type = EDI_DATA_TYPES.get(element_code, get_smart_data_type(segment_tag, i, description))
-                parsed_elements.append({
-                    'line_number': line_num,
-                    'segment_tag': segment_tag,
-                    'element_position': f'{segment_tag}{i:02d}',
-                    'element_code': element_code,
-                    'element_value': element if element else '(empty)',
-                    'data_type': data_type,
-                    'element_description': description
-                })
+            info = element_info.get((segment_tag, i))
+            if info is None:
+                if i == 0:
+                    # First element is the segment tag itself
+                    info = (segment_tag, 'Segment ID', segment_tag, 'ID', f'{segment_tag} - Segment Identifier')
+                else:
+                    # Subsequent elements are numbered positions
+                    element_code = f'{segment_tag}{i:02d}'
+                    # Get description first to determine data type
+                    description = get_element_description(segment_tag, i, element)
+                    # The validation rule's type wins so an element and its violations agree;
+                    # elements without a rule fall back to the display mapping, then the description
+                    rule = EDI_ELEMENT_RULES.get(element_code)
+                    if rule is not None:
+                        data_type = rule[0]
+                    else:
+                        data_type = EDI_DATA_TYPES.get(element_code, get_smart_data_type(segment_tag, i, description))
+                    info = (segment_tag, element_code, element_code, data_type, description)
+                element_info[(segment_tag, i)] = info
+            
+            parsed_elements.append({
+                'line_number': line_num,
+                'segment_tag': info[0],
+                'element_position': info[1],
+                'element_code': info[2],
+                'element_value': element if element or i == 0 else '(empty)',
+                'data_type': info[3],
+                'element_description': info[4]
+            })
     
     return parsed_elements
 
@@ -356,151 +1205,114 @@ def get_smart_data_type(segment_tag, position, description):
 
 def get_element_description(segment_tag, position, value):
     """Get description for specific EDI elements"""
-    descriptions = {
-        'ISA': {
-            1: 'Authorization Information Qualifier',
-            2: 'Authorization Information',
-            3: 'Security Information Qualifier', 
-            4: 'Security Information',
-            5: 'Interchange ID Qualifier',
-            6: 'Interchange Sender ID',
-            7: 'Interchange ID Qualifier',
-            8: 'Interchange Receiver ID',
-            9: 'Interchange Date',
-            10: 'Interchange Time',
-            11: 'Interchange Control Standards Identifier',
-            12: 'Interchange Control Version Number',
-            13: 'Interchange Control Number',
-            14: 'Acknowledgment Requested',
-            15: 'Usage Indicator',
-            16: 'Component Element Separator'
-        },
-        'GS': {
-            1: 'Functional Identifier Code',
-            2: 'Application Sender\'s Code',
-            3: 'Application Receiver\'s Code', 
-            4: 'Date',
-            5: 'Time',
-            6: 'Group Control Number',
-            7: 'Responsible Agency Code',
-            8: 'Version / Release / Industry Identifier Code'
-        },
-        'ST': {
-            1: 'Transaction Set Identifier Code',
-            2: 'Transaction Set Control Number'
-        },
-        'BAK': {
-            1: 'Transaction Set Purpose Code',
-            2: 'Acknowledgment Type',
-            3: 'Purchase Order Number',
-            4: 'Date'
-        },
-        'PO1': {
-            1: 'Assigned Identification',
-            2: 'Quantity Ordered',
-            3: 'Unit or Basis for Measurement Code',
-            4: 'Unit Price',
-            5: 'Basis of Unit Price Code',
-            6: 'Product/Service ID Qualifier',
-            7: 'Product/Service ID',
-            8: 'Product/Service ID Qualifier',
-            9: 'Product/Service ID',
-            10: 'Product/Service ID Qualifier',
-            11: 'Product/Service ID'
-        },
-        'ACK': {
-            1: 'Line Item Status Code',
-            2: 'Quantity',
-            3: 'Unit or Basis for Measurement Code',
-            4: 'Date/Time Qualifier',
-            5: 'Date',
-            6: 'Request Reference Number',
-            7: 'Product/Service ID Qualifier',
-            8: 'Product/Service ID'
-        },
-        'CTT': {
-            1: 'Number of Line Items'
-        },
-        'SE': {
-            1: 'Number of Included Segments',
-            2: 'Transaction Set Control Number'
-        },
-        'GE': {
-            1: 'Number of Transaction Sets Included',
-            2: 'Group Control Number'
-        },
-        'IEA': {
-            1: 'Number of Included Functional Groups',
-            2: 'Interchange Control Number'
-        }
-    }
-    
-    if segment_tag in descriptions and position in descriptions[segment_tag]:
-        return descriptions[segment_tag][position]
+    if segment_tag in EDI_ELEMENT_DESCRIPTIONS and position in EDI_ELEMENT_DESCRIPTIONS[segment_tag]:
+        return EDI_ELEMENT_DESCRIPTIONS[segment_tag][position]
     else:
         return f'{segment_tag} Element {position}'
 
-def convert_edi_to_json(edi_data):
-    """Convert EDI 855 format data to structured JSON"""
+# Sections of the convert_edi_to_json result, and the segments that populate them
+EDI_JSON_SECTIONS = ('interchange', 'functional_group', 'transaction_set', 'acknowledgments',
+                     'line_items', 'summary', 'raw_segments')
+EDI_SECTION_SEGMENTS = MappingProxyType({
+    'interchange': ('ISA', 'IEA'),
+    'functional_group': ('GS', 'GE'),
+    'transaction_set': ('ST', 'BAK', 'SE'),
+    'acknowledgments': ('ACK',),
+    'line_items': ('PO1',),
+    'summary': ('CTT',)
+})
+
+def parse_fields_param(fields):
+    """Turn a fields= value (comma string or list) into a set of sections; None means all"""
+    if fields is None or fields == '' or fields == []:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    elif not isinstance(fields, (list, tuple)) or not all(isinstance(field, str) for field in fields):
+        raise ValueError("fields must be a comma-separated string or a list of strings")
+    requested = {field.strip() for field in fields if field.strip()}
+    unknown = requested - set(EDI_JSON_SECTIONS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}. "
+                         f"Available fields: {', '.join(EDI_JSON_SECTIONS)}")
+    return requested
+
+def convert_edi_to_json(edi_data, fields=None):
+    """Convert EDI 855 format data to structured JSON, building only the requested sections"""
     if not edi_data:
         return {"error": "No EDI data provided"}
     
+    sections = set(EDI_JSON_SECTIONS) if fields is None else set(fields)
+    result = new_edi_json_result(sections)
+    
+    for section, operation, value in iter_json_operations(edi_json_segments(edi_data, sections), sections):
+        apply_json_operation(result, section, operation, value)
+    
+    return result
+
+def section_segment_tags(sections):
+    """Return the segment tags that populate the requested JSON sections"""
+    tags = set()
+    for section in sections:
+        tags.update(EDI_SECTION_SEGMENTS.get(section, ()))
+    return tags
+
+def edi_json_segments(edi_data, sections):
+    """Tokenize EDI data for convert_edi_to_json, splitting only the segments the sections need"""
+    # Without raw_segments only the segments feeding a requested section are split
+    tags = None if "raw_segments" in sections else section_segment_tags(sections)
+    return iter_edi_segments(edi_data, tags=tags)
+
+def new_edi_json_result(sections):
+    """Return an empty convert_edi_to_json result holding the requested sections"""
+    empty_sections = {
+        "interchange": dict,
+        "functional_group": dict,
+        "transaction_set": dict,
+        "acknowledgments": list,
+        "line_items": list,
+        "summary": dict,
+        "raw_segments": list
+    }
     result = {
         "transaction_type": "EDI 855 - Purchase Order Acknowledgment",
-        "parsed_date": datetime.now().isoformat(),
-        "interchange": {},
-        "functional_group": {},
-        "transaction_set": {},
-        "acknowledgments": [],
-        "line_items": [],
-        "summary": {},
-        "raw_segments": []
+        "parsed_date": datetime.now().isoformat()
     }
+    for section in EDI_JSON_SECTIONS:
+        if section in sections:
+            result[section] = empty_sections[section]()
+    return result
+
+def apply_json_operation(result, section, operation, value):
+    """Apply one (section, operation, value) change to a convert_edi_to_json result"""
+    if operation == 'set':
+        result[section] = value
+    elif operation == 'update':
+        result[section].update(value)
+    else:
+        result[section].append(value)
+
+def iter_json_operations(segments, sections):
+    """Yield (section, operation, value) for each change the segments make to the JSON result"""
+    keep_raw = "raw_segments" in sections
+    wanted_tags = section_segment_tags(sections)
     
-    lines = edi_data.strip().split('\n')
-    
-    for line in lines:
-        line = line.strip()
-        if not line or '~' not in line:
-            continue
-            
-        segment_data = line.rstrip('~')
-        if '*' not in segment_data:
-            continue
-            
-        elements = segment_data.split('*')
+    for line_num, line, elements in segments:
         segment_tag = elements[0] if elements else ''
         
         # Store raw segment
-        result["raw_segments"].append({
-            "segment": segment_tag,
-            "raw_data": line,
-            "elements": elements
-        })
+        if keep_raw:
+            yield "raw_segments", "append", {
+                "segment": segment_tag,
+                "raw_data": line,
+                "elements": elements
+            }
+            if segment_tag not in wanted_tags:
+                continue
         
         # Parse specific segments
-        if segment_tag == 'ISA':
-            result["interchange"] = parse_isa_segment(elements)
-        elif segment_tag == 'GS':
-            result["functional_group"] = parse_gs_segment(elements)
-        elif segment_tag == 'ST':
-            result["transaction_set"] = parse_st_segment(elements)
-        elif segment_tag == 'BAK':
-            result["transaction_set"].update(parse_bak_segment(elements))
-        elif segment_tag == 'PO1':
-            result["line_items"].append(parse_po1_segment(elements))
-        elif segment_tag == 'ACK':
-            result["acknowledgments"].append(parse_ack_segment(elements))
-        elif segment_tag == 'CTT':
-            result["summary"].update(parse_ctt_segment(elements))
-        elif segment_tag == 'SE':
-            result["transaction_set"].update(parse_se_segment(elements))
-        elif segment_tag == 'GE':
-            result["functional_group"].update(parse_ge_segment(elements))
-        elif segment_tag == 'IEA':
-            result["interchange"].update(parse_iea_segment(elements))
-    
-    return result
+        section, operation, parse_segment = EDI_SEGMENT_HANDLERS[segment_tag]
+        yield section, operation, parse_segment(elements)
 
 def parse_isa_segment(elements):
     """Parse ISA segment"""
@@ -600,16 +1412,7 @@ def parse_ack_segment(elements):
     """Parse ACK segment"""
     status_code = elements[1] if len(elements) > 1 else ''
     
-    # Map ACK status codes to descriptions
-    status_descriptions = {
-        'IA': 'Item Accepted',
-        'IB': 'Item Backordered', 
-        'IC': 'Item Accepted - Changes Made',
-        'ID': 'Item Deleted',
-        'IR': 'Item Rejected'
-    }
-    
-    status_description = status_descriptions.get(status_code, f'Unknown Status ({status_code})')
+    status_description = ACK_STATUS_DESCRIPTIONS.get(status_code, f'Unknown Status ({status_code})')
     
     return {
         "status_code": status_code,
@@ -647,10 +1450,1454 @@ def parse_iea_segment(elements):
         "interchange_control_number": elements[2] if len(elements) > 2 else ''
     }
 
+# How each segment changes the JSON result: (section, operation, parser)
+EDI_SEGMENT_HANDLERS = MappingProxyType({
+    'ISA': ('interchange', 'set', parse_isa_segment),
+    'GS': ('functional_group', 'set', parse_gs_segment),
+    'ST': ('transaction_set', 'set', parse_st_segment),
+    'BAK': ('transaction_set', 'update', parse_bak_segment),
+    'PO1': ('line_items', 'append', parse_po1_segment),
+    'ACK': ('acknowledgments', 'append', parse_ack_segment),
+    'CTT': ('summary', 'update', parse_ctt_segment),
+    'SE': ('transaction_set', 'update', parse_se_segment),
+    'GE': ('functional_group', 'update', parse_ge_segment),
+    'IEA': ('interchange', 'update', parse_iea_segment)
+})
+
+def use_parallel_parse(edi_data, parallel=None):
+    """Decide whether to parse in slices; None means only when the data is large enough"""
+    if PARALLEL_PARSE_WORKERS <= 1:
+        return False
+    if parallel is None:
+        return len(edi_data) >= PARALLEL_PARSE_THRESHOLD
+    return bool(parallel)
+
+def parse_parallel_param(value):
+    """Turn a parallel= value into True, False or None (automatic)"""
+    if value is None or value == '' or value == 'auto':
+        return None
+    return str(value).lower() in ('1', 'true', 'yes')
+
+def get_parse_executor():
+    """Return the process pool used for parallel parsing, starting it on first use"""
+    global parse_executor
+    with parse_executor_lock:
+        if parse_executor is None:
+            # forkserver keeps the workers independent of this process's threads
+            # and of the upload buffers it holds
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            if 'forkserver' in methods:
+                context.set_forkserver_preload([__name__])
+            parse_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max(PARALLEL_PARSE_WORKERS, 1), mp_context=context
+            )
+        return parse_executor
+
+# A line break followed by an ST segment; lines may end in \n, \r or \r\n
+TRANSACTION_START_PATTERN = re.compile(rb'[\r\n]ST\*')
+
+def split_at_transactions(buf, target_size):
+    """Split a buffer into (start, end) slices of about target_size bytes, cut before ST segments"""
+    slices = []
+    size = len(buf)
+    start = 0
+    while start < size:
+        match = TRANSACTION_START_PATTERN.search(buf, start + max(target_size, 1) - 1)
+        end = size if match is None else match.start() + 1
+        slices.append((start, end))
+        start = end
+    return slices
+
+def parse_edi_slice(path, start, end, sections):
+    """Convert bytes start:end of an EDI file in a pool worker
+
+    Returns the set/update operations in order, and the appended list items of
+    each section already serialized as comma-separated JSON.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    
+    updates = []
+    appended = defaultdict(list)
+    for section, operation, value in iter_json_operations(edi_json_segments(data, sections), sections):
+        if operation == 'append':
+            appended[section].append(value)
+        else:
+            updates.append((section, operation, value))
+    return updates, {section: json.dumps(items)[1:-1] for section, items in appended.items()}
+
+def convert_edi_to_json_text(edi_data, fields=None):
+    """Convert EDI data to serialized JSON by parsing ST-aligned slices across the process pool"""
+    sections = set(EDI_JSON_SECTIONS) if fields is None else set(fields)
+    buf = edi_data.encode('utf-8') if isinstance(edi_data, str) else edi_data
+    target_size = -(-len(buf) // (max(PARALLEL_PARSE_WORKERS, 1) * PARALLEL_SLICES_PER_WORKER))
+    
+    # Workers read their own slice from a shared file by offset, so only the
+    # offsets are sent to them rather than the EDI text itself. A stored upload
+    # is hard-linked instead of copied; the link keeps it readable if the upload
+    # store prunes it meanwhile
+    with tempfile.TemporaryDirectory(prefix='edi-parse-') as spool_dir:
+        path = os.path.join(spool_dir, 'data.edi')
+        source = edi_file_paths.get(edi_data) if isinstance(edi_data, mmap.mmap) else None
+        if source is not None:
+            try:
+                os.link(source, path)
+            except OSError:
+                source = None
+        if source is None:
+            with open(path, 'wb') as spool:
+                spool.write(buf)
+        
+        executor = get_parse_executor()
+        futures = [
+            executor.submit(parse_edi_slice, path, start, end, sections)
+            for start, end in split_at_transactions(buf, target_size)
+        ]
+        
+        # Replaying the slices in file order keeps the single-pass semantics,
+        # e.g. a later ST still replaces the transaction set
+        result = new_edi_json_result(sections)
+        fragments = defaultdict(list)
+        for future in futures:
+            updates, appended = future.result()
+            for section, operation, value in updates:
+                apply_json_operation(result, section, operation, value)
+            for section, items in appended.items():
+                if items:
+                    fragments[section].append(items)
+    
+    parts = []
+    for key, value in result.items():
+        if isinstance(value, list):
+            value_text = '[' + ','.join(fragments[key]) + ']'
+        else:
+            value_text = json.dumps(value)
+        parts.append(f'{json.dumps(key)}: {value_text}')
+    return '{' + ', '.join(parts) + '}'
+
+def edi_json_response(payload, edi_data, fields=None, parallel=None):
+    """Return payload plus the converted EDI under json_data, parsing in parallel when chosen"""
+    if not use_parallel_parse(edi_data, parallel):
+        return jsonify({**payload, "json_data": convert_edi_to_json(edi_data, fields)})
+    
+    # The document is already serialized, so it is spliced into the response body
+    body = json.dumps(payload)[:-1] + f', "json_data": {convert_edi_to_json_text(edi_data, fields)}}}'
+    return current_app.response_class(body, mimetype='application/json')
+
+NUMERIC_PATTERN = re.compile(r'-?\d+')
+DECIMAL_PATTERN = re.compile(r'-?(?:\d+\.?\d*|\.\d+)')
+ALPHANUMERIC_PATTERN = re.compile(r'[\x20-\x7e]+')
+DAYS_IN_MONTH = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+def _valid_date(value):
+    if not value.isdigit() or len(value) not in (6, 8):
+        return False
+    year, month, day = int(value[:-4]), int(value[-4:-2]), int(value[-2:])
+    if len(value) == 6:
+        year += 2000
+    if not 1 <= month <= 12 or not 1 <= day <= DAYS_IN_MONTH[month]:
+        return False
+    return month != 2 or day < 29 or (year % 4 == 0 and (year % 100 != 0 or year % 400 == 0))
+
+def _valid_time(value):
+    if not value.isdigit() or not 4 <= len(value) <= 8:
+        return False
+    return int(value[:2]) < 24 and int(value[2:4]) < 60 and (len(value) < 6 or int(value[4:6]) < 60)
+
+def compile_element_check(data_type, min_length, max_length, codes=None):
+    """Build one check function for an element; it returns (rule, message) or None"""
+    code_set = frozenset(codes) if codes else None
+    length_range = str(min_length) if min_length == max_length else f'{min_length}-{max_length}'
+    
+    if data_type.startswith('N') or data_type == 'R':
+        pattern = NUMERIC_PATTERN if data_type.startswith('N') else DECIMAL_PATTERN
+        type_name = 'numeric' if data_type.startswith('N') else 'decimal'
+        
+        def check(value):
+            if not pattern.fullmatch(value):
+                return 'type', f'Expected {type_name} ({data_type}) value'
+            # Signs and decimal points do not count towards X12 numeric lengths
+            digits = len(value) - value.startswith('-') - ('.' in value)
+            if not min_length <= digits <= max_length:
+                return 'length', f'Expected {length_range} digits, got {digits}'
+            return None
+    elif data_type == 'DT':
+        def check(value):
+            if len(value) != min_length and len(value) != max_length:
+                return 'length', f'Expected a {max_length}-digit date, got {len(value)} characters'
+            if not _valid_date(value):
+                return 'date', 'Invalid date'
+            return None
+    elif data_type == 'TM':
+        def check(value):
+            if not min_length <= len(value) <= max_length:
+                return 'length', f'Expected {length_range} characters, got {len(value)}'
+            if not _valid_time(value):
+                return 'time', 'Invalid time'
+            return None
+    else:
+        def check(value):
+            if not min_length <= len(value) <= max_length:
+                return 'length', f'Expected {length_range} characters, got {len(value)}'
+            if code_set is not None and value not in code_set:
+                return 'code_list', f'Code not in allowed list ({", ".join(sorted(code_set))})'
+            if not ALPHANUMERIC_PATTERN.fullmatch(value):
+                return 'type', f'Expected printable characters ({data_type})'
+            return None
+    
+    return check
+
+def compile_element_checks(rules):
+    """Compile element rules into per-segment lists indexed by element position"""
+    compiled = {}
+    for element_code, (data_type, min_length, max_length, codes) in rules.items():
+        segment_tag, position = element_code[:-2], int(element_code[-2:])
+        checks = compiled.setdefault(segment_tag, [])
+        checks.extend([None] * (position + 1 - len(checks)))
+        checks[position] = (element_code, data_type, compile_element_check(data_type, min_length, max_length, codes))
+    return {segment_tag: tuple(checks) for segment_tag, checks in compiled.items()}
+
+COMPILED_ELEMENT_CHECKS = compile_element_checks(EDI_ELEMENT_RULES)
+
+def validate_edi_elements(edi_data, compiled_checks=COMPILED_ELEMENT_CHECKS, limit=None):
+    """Check every element against its compiled rule in one pass over the segments"""
+    return check_edi_segments(iter_edi_segments(edi_data), compiled_checks, limit)
+
+def check_edi_segments(segments, compiled_checks=COMPILED_ELEMENT_CHECKS, limit=None):
+    """Check a stream of (line_number, raw_line, elements) segments against the compiled rules"""
+    violations = []
+    violation_count = 0
+    elements_checked = 0
+    by_rule = defaultdict(int)
+    
+    for line_num, line, elements in segments:
+        checks = compiled_checks.get(elements[0])
+        if checks is None:
+            continue
+        for position in range(1, min(len(elements), len(checks))):
+            value = elements[position]
+            rule = checks[position]
+            # Empty elements are a usage question, not a data type one
+            if rule is None or not value:
+                continue
+            elements_checked += 1
+            failure = rule[2](value)
+            if failure is None:
+                continue
+            violation_count += 1
+            by_rule[failure[0]] += 1
+            if limit is None or len(violations) < limit:
+                violations.append({
+                    "line_number": line_num,
+                    "segment_tag": elements[0],
+                    "element_position": position,
+                    "element_code": rule[0],
+                    "element_value": value,
+                    "data_type": rule[1],
+                    "rule": failure[0],
+                    "message": failure[1]
+                })
+    
+    return {
+        "elements_checked": elements_checked,
+        "violation_count": violation_count,
+        "violations_by_rule": dict(by_rule),
+        "violations": violations,
+        "truncated": violation_count > len(violations)
+    }
+
+def parse_edi_number(value):
+    """Convert an EDI numeric element to float, or None if it is empty or invalid"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def build_line_item_columns(edi_data):
+    """Collect PO1 and ACK numerics into typed columns in a single pass"""
+    return collect_line_item_columns(iter_edi_segments(edi_data, tags={'PO1', 'ACK'}))
+
+def collect_line_item_columns(segments):
+    """Collect PO1 and ACK numerics from a stream of (line_number, raw_line, elements) segments"""
+    columns = {
+        "po1_line_number": [],
+        "po1_quantity": array('d'),
+        "po1_unit_price": array('d'),
+        "ack_po1_index": array('l'),
+        "ack_status": [],
+        "ack_quantity": array('d'),
+        "invalid_numbers": 0
+    }
+    nan = float('nan')
+    invalid = 0
+    
+    # Empty optional elements are missing, not invalid; only non-empty values
+    # that fail to parse are counted
+    for line_num, line, elements in segments:
+        segment_tag = elements[0]
+        if segment_tag == 'PO1':
+            raw_quantity = elements[2] if len(elements) > 2 else ''
+            raw_unit_price = elements[4] if len(elements) > 4 else ''
+            quantity = parse_edi_number(raw_quantity)
+            unit_price = parse_edi_number(raw_unit_price)
+            invalid += ((quantity is None and bool(raw_quantity.strip()))
+                        + (unit_price is None and bool(raw_unit_price.strip())))
+            columns["po1_line_number"].append(elements[1] if len(elements) > 1 else '')
+            columns["po1_quantity"].append(nan if quantity is None else quantity)
+            columns["po1_unit_price"].append(nan if unit_price is None else unit_price)
+        elif segment_tag == 'ACK':
+            raw_quantity = elements[2] if len(elements) > 2 else ''
+            quantity = parse_edi_number(raw_quantity)
+            invalid += quantity is None and bool(raw_quantity.strip())
+            # ACKs belong to the PO1 loop they follow; -1 when there is none yet
+            columns["ack_po1_index"].append(len(columns["po1_line_number"]) - 1)
+            columns["ack_status"].append(elements[1] if len(elements) > 1 else '')
+            columns["ack_quantity"].append(nan if quantity is None else quantity)
+    
+    columns["invalid_numbers"] = invalid
+    return columns
+
+def _nansum(values):
+    return math.fsum(v for v in values if v == v)
+
+def compute_line_item_analytics(columns, mismatch_limit=100):
+    """Aggregate acknowledged quantities, extended prices and PO1/ACK mismatches"""
+    po1_quantity = columns["po1_quantity"]
+    po1_unit_price = columns["po1_unit_price"]
+    ack_po1_index = columns["ack_po1_index"]
+    ack_status = columns["ack_status"]
+    ack_quantity = columns["ack_quantity"]
+    
+    # Extended price per line, computed once as a column
+    extended_price = array('d', map(operator.mul, po1_quantity, po1_unit_price))
+    
+    # Acknowledged quantity per PO1 line and per status, in one pass over the ACK columns
+    acknowledged = array('d', bytes(8 * len(po1_quantity)))
+    by_status = {}
+    for po1_index, status, quantity in zip(ack_po1_index, ack_status, ack_quantity):
+        group = by_status.get(status)
+        if group is None:
+            group = by_status[status] = {
+                "status_description": ACK_STATUS_DESCRIPTIONS.get(status, f'Unknown Status ({status})'),
+                "acknowledgment_count": 0,
+                "quantity_acknowledged": 0.0,
+                "extended_price": 0.0
+            }
+        group["acknowledgment_count"] += 1
+        if quantity == quantity:
+            group["quantity_acknowledged"] += quantity
+            if po1_index >= 0:
+                acknowledged[po1_index] += quantity
+                unit_price = po1_unit_price[po1_index]
+                if unit_price == unit_price:
+                    group["extended_price"] += quantity * unit_price
+    
+    for group in by_status.values():
+        group["quantity_acknowledged"] = round(group["quantity_acknowledged"], 4)
+        group["extended_price"] = round(group["extended_price"], 4)
+    
+    # Lines whose ordered quantity differs from the sum of their ACK quantities;
+    # ACKs without a quantity do not make a line comparable
+    has_ack = array('b', bytes(len(po1_quantity)))
+    for po1_index, quantity in zip(ack_po1_index, ack_quantity):
+        if po1_index >= 0 and quantity == quantity:
+            has_ack[po1_index] = 1
+    mismatch_indexes = [
+        i for i, (ordered, acked, flagged) in enumerate(zip(po1_quantity, acknowledged, has_ack))
+        if flagged and ordered == ordered and abs(ordered - acked) > 1e-9
+    ]
+    
+    return {
+        "line_item_count": len(po1_quantity),
+        "acknowledgment_count": len(ack_quantity),
+        "total_quantity_ordered": round(_nansum(po1_quantity), 4),
+        "total_quantity_acknowledged": round(_nansum(ack_quantity), 4),
+        "total_extended_price": round(_nansum(extended_price), 4),
+        "invalid_numbers": columns["invalid_numbers"],
+        "by_status": dict(sorted(by_status.items())),
+        "quantity_mismatch_count": len(mismatch_indexes),
+        "quantity_mismatches": [
+            {
+                "line_number": columns["po1_line_number"][i],
+                "quantity_ordered": po1_quantity[i],
+                "quantity_acknowledged": acknowledged[i],
+                "difference": acknowledged[i] - po1_quantity[i]
+            }
+            for i in mismatch_indexes[:mismatch_limit]
+        ],
+        "lines_without_acknowledged_quantity": len(po1_quantity) - sum(has_ack)
+    }
+
+# Parts of analyze_edi that are only built when asked for
+ANALYSIS_PARTS = ('elements', 'json', 'element_validation', 'line_item_columns')
+
+def analyze_edi(edi_data, parts=ANALYSIS_PARTS):
+    """Tokenize EDI data once and build the requested parts from that segment stream
+
+    Always returns the segments present (in first-seen order), their counts and
+    the element count; parts may add the element list, the full
+    convert_edi_to_json result, the complete element validation report and
+    the line item columns.
+    """
+    # Presence and counts keep the original /analyze-spec rule of any line with
+    # a '*', so an unterminated segment is still present; only segments that
+    # iter_edi_segments would yield feed the elements, JSON and validation
+    segments = []
+    segment_counts = defaultdict(int)
+    for line_num, line in iter_edi_lines(edi_data):
+        line = line.strip()
+        if '*' not in line:
+            continue
+        segment_counts[line.split('*', 1)[0]] += 1
+        segment_data = line.rstrip('~')
+        if '~' in line and '*' in segment_data:
+            segments.append((line_num, line, segment_data.split('*')))
+    
+    analysis = {
+        "segments_present": [segment_tag for segment_tag in segment_counts if segment_tag],
+        "segment_counts": dict(segment_counts),
+        "element_count": sum(len(elements) for _, _, elements in segments)
+    }
+    if "elements" in parts:
+        analysis["elements"] = build_edi_elements(segments)
+    if "json" in parts:
+        sections = set(EDI_JSON_SECTIONS)
+        json_result = analysis["json"] = new_edi_json_result(sections)
+        for section, operation, value in iter_json_operations(segments, sections):
+            apply_json_operation(json_result, section, operation, value)
+    if "element_validation" in parts:
+        analysis["element_validation"] = check_edi_segments(segments)
+    if "line_item_columns" in parts:
+        analysis["line_item_columns"] = collect_line_item_columns(segments)
+    return analysis
+
+def get_cached_analysis_part(edi_data, part, build=True):
+    """Return one analysis part for EDI data from the latest upload, or None if it is not
+
+    A missing part is built and kept with the upload unless build is False.
+    """
+    upload = get_uploaded_edi('latest')
+    if not upload or upload["edi_data"] is not edi_data:
+        return None
+    analysis = upload["analysis"]
+    if analysis is None or part not in analysis:
+        if not build:
+            return None
+        analysis = upload["analysis"] = {**(analysis or {}), **analyze_edi(edi_data, (part,))}
+    return analysis[part]
+
+def truncate_validation(validation, limit=None):
+    """Return a validation report that lists at most limit violations"""
+    if limit is None or len(validation["violations"]) <= limit:
+        return validation
+    return {**validation, "violations": validation["violations"][:limit], "truncated": True}
+
+def project_edi_json(json_result, fields=None):
+    """Restrict a full convert_edi_to_json result to the requested sections"""
+    if fields is None:
+        return json_result
+    return {key: value for key, value in json_result.items() if key not in EDI_JSON_SECTIONS or key in fields}
+
+# Typecodes of the array columns in collect_line_item_columns output
+LINE_ITEM_ARRAY_COLUMNS = MappingProxyType({
+    'po1_quantity': 'd',
+    'po1_unit_price': 'd',
+    'ack_po1_index': 'l',
+    'ack_quantity': 'd'
+})
+
+def dump_analysis(analysis):
+    """Serialize an analyze_edi result to compressed JSON
+
+    The element list is left out: it repeats json.raw_segments element by
+    element, and get_element_index rebuilds it on first use.
+    """
+    analysis = {key: value for key, value in analysis.items() if key != "elements"}
+    if "line_item_columns" in analysis:
+        analysis["line_item_columns"] = {
+            name: values.tolist() if name in LINE_ITEM_ARRAY_COLUMNS else values
+            for name, values in analysis["line_item_columns"].items()
+        }
+    return zlib.compress(json.dumps(analysis).encode('utf-8'))
+
+def load_analysis(blob):
+    """Restore an analyze_edi result written by dump_analysis"""
+    analysis = json.loads(zlib.decompress(blob))
+    columns = analysis.get("line_item_columns")
+    if columns is not None:
+        for name, typecode in LINE_ITEM_ARRAY_COLUMNS.items():
+            columns[name] = array(typecode, columns[name])
+    return analysis
+
+def interchange_identity(edi_data):
+    """Return the sender, receiver, ISA13 control number and content hash of an interchange
+
+    Returns None when the data has no ISA segment.
+    """
+    for line_num, line, elements in iter_edi_segments(edi_data, tags={'ISA'}):
+        if len(elements) < 14:
+            return None
+        sender = f"{elements[5].strip()}:{elements[6].strip()}"
+        receiver = f"{elements[7].strip()}:{elements[8].strip()}"
+        control_number = elements[13].strip()
+        break
+    else:
+        return None
+    
+    # Hash the content without surrounding whitespace, straight from the buffer
+    if isinstance(edi_data, str):
+        content_hash = hashlib.sha256(edi_data.strip().encode('utf-8')).hexdigest()
+    else:
+        start, end = 0, len(edi_data)
+        while start < end and edi_data[start] in b' \t\r\n':
+            start += 1
+        while end > start and edi_data[end - 1] in b' \t\r\n':
+            end -= 1
+        with memoryview(edi_data) as view:
+            content_hash = hashlib.sha256(view[start:end]).hexdigest()
+    
+    control_key = f"{sender}|{receiver}|{control_number}"
+    return {
+        "sender": sender,
+        "receiver": receiver,
+        "control_number": control_number,
+        "content_hash": content_hash,
+        "control_key": control_key,
+        "key": f"{control_key}|{content_hash}",
+        "size": len(edi_data)
+    }
+
+class BloomFilter:
+    """Fixed-size Bloom filter, in memory or in a file shared by all workers
+
+    With a path the bit array is a shared memory map of
+    '<path>.<bits>x<hashes>', so a change of sizing starts a new file.
+    """
+    
+    def __init__(self, capacity, fp_rate, path=None):
+        capacity = max(capacity, 1)
+        self.size = max(64, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        byte_size = (self.size + 7) // 8
+        self.created = True
+        
+        if path is None:
+            self.bits = bytearray(byte_size)
+            return
+        fd = os.open(f'{path}.{self.size}x{self.hashes}', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self.created = os.fstat(fd).st_size < byte_size
+            if self.created:
+                os.ftruncate(fd, byte_size)
+            self.bits = mmap.mmap(fd, byte_size)
+        finally:
+            os.close(fd)
+    
+    def positions(self, item):
+        """Bit positions of an item, by double hashing one 128-bit digest"""
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+    
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+    
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+    
+    def clear(self):
+        self.bits[:] = bytes(len(self.bits))
+
+class InterchangeIndex:
+    """Index of seen interchanges with their stored analysis, for duplicate detection
+
+    Entries are keyed on sender, receiver, ISA13 and content hash; the control
+    key alone is indexed too so a reused control number with different content
+    is reported. A Bloom filter over both keys answers most first-time lookups
+    without touching the store. Uses SQLite on local disk by default, bounded to
+    limit rows, or Redis with a ttl so all workers and hosts share one index.
+    """
+    
+    def __init__(self, path=DUPLICATE_INDEX_PATH, limit=DUPLICATE_INDEX_LIMIT, ttl=DUPLICATE_INDEX_TTL,
+                 fp_rate=DUPLICATE_BLOOM_FP_RATE, redis_client=None, key_prefix='edi-validator:interchanges',
+                 max_bytes=DUPLICATE_INDEX_MAX_BYTES):
+        self.limit = limit
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.redis = redis_client
+        self.key_prefix = key_prefix
+        self._lock = threading.Lock()
+        
+        if redis_client is not None:
+            # Redis entries expire individually, so the filter rotates every ttl
+            # seconds and lookups consult the current and previous generations
+            self.bloom = BloomFilter(limit, fp_rate)
+            return
+        
+        # Stored results hold partner EDI; SQLite gives its WAL files the
+        # database file's permissions
+        os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        self.db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS interchanges ("
+            "key TEXT PRIMARY KEY, control_key TEXT NOT NULL, first_seen TEXT NOT NULL, "
+            "last_seen TEXT NOT NULL, times_seen INTEGER NOT NULL, result BLOB)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS interchanges_control ON interchanges (control_key)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS index_meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.bloom = BloomFilter(limit, fp_rate, path=path + '.bloom')
+        if self.bloom.created:
+            with self._lock:
+                self.db.execute("BEGIN IMMEDIATE")
+                try:
+                    self._rebuild_bloom()
+                    self.db.execute("COMMIT")
+                except Exception:
+                    self.db.execute("ROLLBACK")
+                    raise
+    
+    def _rebuild_bloom(self):
+        # Must run inside BEGIN IMMEDIATE: the write lock keeps other workers'
+        # record() from setting bits that the clear would erase. Evicted rows
+        # stay in the filter as false positives until it is rebuilt
+        self.bloom.clear()
+        for key, control_key in self.db.execute("SELECT key, control_key FROM interchanges"):
+            self.bloom.add('k:' + key)
+            self.bloom.add('c:' + control_key)
+        self.db.execute("INSERT OR REPLACE INTO index_meta (name, value) VALUES ('inserts_since_rebuild', 0)")
+    
+    def _redis_bloom_keys(self):
+        generation = int(time.time() // max(self.ttl, 1))
+        return [f'{self.key_prefix}:bloom:{generation}', f'{self.key_prefix}:bloom:{generation - 1}']
+    
+    def _redis_bloom_add(self, pipe, identity):
+        bloom_key = self._redis_bloom_keys()[0]
+        for item in ('k:' + identity["key"], 'c:' + identity["control_key"]):
+            for position in self.bloom.positions(item):
+                pipe.setbit(bloom_key, position, 1)
+        pipe.expire(bloom_key, self.ttl * 2)
+    
+    def _might_contain(self, item):
+        if self.redis is None:
+            return item in self.bloom
+        positions = self.bloom.positions(item)
+        pipe = self.redis.pipeline(transaction=False)
+        bloom_keys = self._redis_bloom_keys()
+        for bloom_key in bloom_keys:
+            for position in positions:
+                pipe.getbit(bloom_key, position)
+        bits = pipe.execute()
+        return any(all(bits[i:i + len(positions)]) for i in range(0, len(bits), len(positions)))
+    
+    def lookup(self, identity):
+        """Return (entry, control_number_reused); entry holds first_seen, times_seen and analysis"""
+        if not self._might_contain('k:' + identity["key"]):
+            if not self._might_contain('c:' + identity["control_key"]):
+                return None, False
+            return None, self._control_key_reused(identity)
+        
+        now = datetime.now().isoformat()
+        if self.redis is not None:
+            entry_key = f'{self.key_prefix}:entry:{identity["key"]}'
+            first_seen, result = self.redis.hmget(entry_key, 'first_seen', 'result')
+            if first_seen is None:
+                return None, self._control_key_reused(identity)
+            pipe = self.redis.pipeline()
+            pipe.hincrby(entry_key, 'times_seen', 1)
+            pipe.hset(entry_key, 'last_seen', now)
+            pipe.expire(entry_key, self.ttl)
+            pipe.expire(f'{self.key_prefix}:control:{identity["control_key"]}', self.ttl)
+            # The entry now outlives the filter generations it was added to, so
+            # its keys go into the current generation as well
+            self._redis_bloom_add(pipe, identity)
+            times_seen = pipe.execute()[0]
+            first_seen = first_seen.decode() if isinstance(first_seen, bytes) else first_seen
+        else:
+            with self._lock:
+                row = self.db.execute(
+                    "SELECT first_seen, times_seen, result FROM interchanges WHERE key = ?", (identity["key"],)
+                ).fetchone()
+                if row is not None:
+                    self.db.execute(
+                        "UPDATE interchanges SET times_seen = times_seen + 1, last_seen = ? WHERE key = ?",
+                        (now, identity["key"])
+                    )
+            if row is None:
+                # A Bloom false positive, or an entry evicted since it was added
+                return None, self._control_key_reused(identity)
+            first_seen, times_seen, result = row[0], row[1] + 1, row[2]
+        
+        return {
+            "first_seen": first_seen,
+            "times_seen": int(times_seen),
+            "analysis": load_analysis(result) if result else None
+        }, False
+    
+    def _control_key_reused(self, identity):
+        if self.redis is not None:
+            stored_hash = self.redis.get(f'{self.key_prefix}:control:{identity["control_key"]}')
+            stored_hash = stored_hash.decode() if isinstance(stored_hash, bytes) else stored_hash
+            return stored_hash is not None and stored_hash != identity["content_hash"]
+        with self._lock:
+            row = self.db.execute(
+                "SELECT 1 FROM interchanges WHERE control_key = ? AND key != ? LIMIT 1",
+                (identity["control_key"], identity["key"])
+            ).fetchone()
+        return row is not None
+    
+    def record(self, identity, analysis=None):
+        """Store an interchange and its analysis, evicting the oldest entries past the limit"""
+        result = None
+        if analysis is not None and identity.get("size", 0) <= DUPLICATE_RESULT_MAX_EDI_BYTES:
+            result = dump_analysis(analysis)
+        if result is not None and len(result) > DUPLICATE_RESULT_MAX_BYTES:
+            result = None
+        now = datetime.now().isoformat()
+        
+        if self.redis is not None:
+            entry_key = f'{self.key_prefix}:entry:{identity["key"]}'
+            pipe = self.redis.pipeline()
+            pipe.hsetnx(entry_key, 'first_seen', now)
+            pipe.hsetnx(entry_key, 'times_seen', 1)
+            pipe.hset(entry_key, 'last_seen', now)
+            if result is not None:
+                pipe.hset(entry_key, 'result', result)
+            pipe.expire(entry_key, self.ttl)
+            pipe.set(f'{self.key_prefix}:control:{identity["control_key"]}', identity["content_hash"], ex=self.ttl)
+            self._redis_bloom_add(pipe, identity)
+            pipe.execute()
+            return
+        
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute(
+                    "INSERT INTO interchanges (key, control_key, first_seen, last_seen, times_seen, result) "
+                    "VALUES (?, ?, ?, ?, 1, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET last_seen = excluded.last_seen, "
+                    "result = COALESCE(excluded.result, interchanges.result)",
+                    (identity["key"], identity["control_key"], now, now, result)
+                )
+                if result is not None:
+                    # Keep the newest results within max_bytes; older entries
+                    # still detect duplicates but are re-analyzed
+                    self.db.execute(
+                        "UPDATE interchanges SET result = NULL WHERE rowid IN ("
+                        "SELECT rowid FROM (SELECT rowid, SUM(LENGTH(result)) OVER (ORDER BY rowid DESC) AS newer "
+                        "FROM interchanges WHERE result IS NOT NULL) WHERE newer > ?)",
+                        (self.max_bytes,)
+                    )
+                # Rowids grow with each insert, so everything below the newest
+                # limit rows is the oldest
+                self.db.execute(
+                    "DELETE FROM interchanges WHERE rowid <= (SELECT MAX(rowid) FROM interchanges) - ?",
+                    (self.limit,)
+                )
+                self.bloom.add('k:' + identity["key"])
+                self.bloom.add('c:' + identity["control_key"])
+                self.db.execute(
+                    "INSERT INTO index_meta (name, value) VALUES ('inserts_since_rebuild', 1) "
+                    "ON CONFLICT (name) DO UPDATE SET value = value + 1"
+                )
+                inserts = self.db.execute(
+                    "SELECT value FROM index_meta WHERE name = 'inserts_since_rebuild'"
+                ).fetchone()[0]
+                if inserts >= self.limit:
+                    self._rebuild_bloom()
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+def create_interchange_index():
+    """Build the duplicate interchange index, backed by Redis when REDIS_URL is set"""
+    if DUPLICATE_INDEX_LIMIT <= 0:
+        return None
+    if REDIS_URL:
+        try:
+            import redis
+            redis_client = redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+            return InterchangeIndex(redis_client=redis_client)
+        except Exception as e:
+            print(f"Redis unavailable for the interchange index, using local store: {e}")
+    return InterchangeIndex()
+
+interchange_index = None
+interchange_index_pid = None
+interchange_index_lock = threading.Lock()
+
+def get_interchange_index():
+    """Return this process's interchange index, opening it on first use after a fork"""
+    global interchange_index, interchange_index_pid
+    with interchange_index_lock:
+        if interchange_index_pid != os.getpid():
+            interchange_index = create_interchange_index()
+            interchange_index_pid = os.getpid()
+        return interchange_index
+
+def find_duplicate_interchange(edi_data):
+    """Look an interchange up in the index; returns (identity, entry, control_number_reused)
+
+    Index failures are logged and treated as a first sighting, so they never
+    block an upload.
+    """
+    try:
+        index = get_interchange_index()
+        identity = interchange_identity(edi_data) if index is not None else None
+        if identity is None:
+            return None, None, False
+        entry, reused = index.lookup(identity)
+        return identity, entry, reused
+    except Exception as e:
+        print(f"Duplicate interchange lookup failed: {e}")
+        return None, None, False
+
+def describe_duplicate(identity, entry, reused):
+    """Summarize a duplicate lookup for API responses"""
+    if identity is None:
+        return None
+    return {
+        "detected": entry is not None,
+        "control_number_reused": reused,
+        "sender": identity["sender"],
+        "receiver": identity["receiver"],
+        "control_number": identity["control_number"],
+        "content_hash": identity["content_hash"],
+        "first_seen": entry["first_seen"] if entry else None,
+        "times_seen": entry["times_seen"] if entry else 1
+    }
+
+def analyze_edi_once(edi_data, parts=ANALYSIS_PARTS):
+    """Analyze an interchange unless it is a known duplicate; returns (analysis, duplicate summary)
+
+    A duplicate is served its stored analysis, with only the parts it lacks built.
+    """
+    identity, entry, reused = find_duplicate_interchange(edi_data)
+    stored = entry["analysis"] if entry is not None else None
+    missing = [part for part in parts if stored is None or part not in stored]
+    if not missing:
+        return stored, describe_duplicate(identity, entry, reused)
+    
+    analysis = {**(stored or {}), **analyze_edi(edi_data, missing)}
+    if entry is None:
+        record_interchange(identity, analysis)
+    return analysis, describe_duplicate(identity, entry, reused)
+
+def record_interchange(identity, analysis=None):
+    """Add an interchange to the duplicate index, logging rather than raising on failure"""
+    if identity is None:
+        return
+    try:
+        get_interchange_index().record(identity, analysis)
+    except Exception as e:
+        print(f"Failed to record interchange in the duplicate index: {e}")
+
+def keep_uploaded_edi(upload):
+    """Add an upload to this process's store, evicting the oldest and dropping older analyses"""
+    uploaded_edi_store[upload["upload_id"]] = upload
+    uploaded_edi_store.move_to_end(upload["upload_id"])
+    while len(uploaded_edi_store) > UPLOAD_STORE_LIMIT:
+        uploaded_edi_store.popitem(last=False)
+    for older in list(uploaded_edi_store.values())[:-UPLOAD_ANALYSIS_LIMIT or None]:
+        older["analysis"] = None
+        older["element_index"] = None
+    return upload
+
+def store_uploaded_edi(edi_data, filename=None, analysis=None):
+    """Keep an uploaded interchange under a new upload id, evicting the oldest"""
+    upload_id = uuid.uuid4().hex
+    upload = keep_uploaded_edi({
+        "upload_id": upload_id,
+        "filename": filename,
+        "uploaded_at": datetime.now().isoformat(),
+        "edi_data": edi_data,
+        "analysis": analysis,
+        "element_index": None
+    })
+    try:
+        persist_uploaded_edi(upload)
+    except OSError as e:
+        # The upload is still served by this worker
+        print(f"Failed to write upload {upload_id} to {UPLOAD_STORE_DIR}: {e}")
+    return upload_id
+
+def persist_uploaded_edi(upload):
+    """Write an upload's EDI data and metadata to the shared upload directory"""
+    os.makedirs(UPLOAD_STORE_DIR, mode=0o700, exist_ok=True)
+    base = os.path.join(UPLOAD_STORE_DIR, upload["upload_id"])
+    edi_data = upload["edi_data"]
+    
+    # Write under a temporary name and rename, so other workers never map a partial file
+    for path, content in ((base + '.edi', edi_data.encode('utf-8') if isinstance(edi_data, str) else edi_data),
+                          (base + '.json', json.dumps({key: upload[key] for key in ('filename', 'uploaded_at')}).encode())):
+        partial = f'{path}.{os.getpid()}.tmp'
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(partial, path)
+    if not isinstance(edi_data, str):
+        edi_file_paths[edi_data] = base + '.edi'
+    
+    for upload_id in stored_upload_ids()[UPLOAD_STORE_LIMIT:]:
+        for extension in ('.json', '.edi'):
+            try:
+                os.remove(os.path.join(UPLOAD_STORE_DIR, upload_id + extension))
+            except FileNotFoundError:
+                pass
+
+def stored_upload_ids():
+    """Ids of the uploads in the shared directory, newest first"""
+    stored = []
+    try:
+        for entry in os.scandir(UPLOAD_STORE_DIR):
+            if entry.name.endswith('.json'):
+                stored.append((entry.stat().st_mtime, entry.name[:-5]))
+    except OSError:
+        # Another worker removed a file mid-scan, or the directory does not exist yet
+        pass
+    return [upload_id for _, upload_id in sorted(stored, reverse=True)]
+
+def load_uploaded_edi(upload_id):
+    """Load an upload written by another worker, or None if it is not in the shared directory"""
+    base = os.path.join(UPLOAD_STORE_DIR, upload_id)
+    try:
+        with open(base + '.json') as f:
+            metadata = json.load(f)
+        with open(base + '.edi', 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < EDI_MMAP_THRESHOLD or size == 0:
+                edi_data = f.read().decode('utf-8')
+            else:
+                edi_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                edi_file_paths[edi_data] = base + '.edi'
+    except (OSError, ValueError):
+        return None
+    
+    # The element index is rebuilt on first query in this worker
+    return keep_uploaded_edi(dict(metadata, upload_id=upload_id, edi_data=edi_data, analysis=None,
+                                  element_index=None))
+
+def get_uploaded_edi(upload_id):
+    """Look up a stored upload; 'latest' returns the most recent one from any worker"""
+    if upload_id == 'latest':
+        for stored_id in stored_upload_ids()[:1]:
+            upload = get_uploaded_edi(stored_id)
+            if upload is not None:
+                return upload
+        return uploaded_edi_store[next(reversed(uploaded_edi_store))] if uploaded_edi_store else None
+    upload = uploaded_edi_store.get(upload_id)
+    if upload is None and UPLOAD_ID_PATTERN.fullmatch(upload_id):
+        upload = load_uploaded_edi(upload_id)
+    return upload
+
+def get_element_index(upload):
+    """Return the element index for a stored upload, building it on first use"""
+    if upload["element_index"] is None:
+        # The index holds the element list, so it is not kept in the analysis too
+        elements = (upload["analysis"] or {}).pop("elements", None)
+        if elements is None:
+            elements = parse_edi_elements(upload["edi_data"])
+        upload["element_index"] = ElementIndex(elements)
+    return upload["element_index"]
+
+class ElementIndex:
+    """Posting lists over parse_edi_elements output for exact and prefix lookups
+
+    Every posting list holds element ids (positions in the element list) in
+    ascending order, so the last id of a page is a stable pagination cursor.
+    """
+    
+    def __init__(self, elements):
+        self.elements = elements
+        self.by_segment = defaultdict(list)
+        self.by_code = defaultdict(list)
+        self.by_line = defaultdict(list)
+        self.by_value = defaultdict(list)
+        
+        for element_id, element in enumerate(elements):
+            self.by_segment[element['segment_tag'].lower()].append(element_id)
+            self.by_code[element['element_code'].lower()].append(element_id)
+            self.by_line[element['line_number']].append(element_id)
+            self.by_value[element['element_value'].lower()].append(element_id)
+        
+        # Sorted distinct keys let prefix lookups bisect to the matching range
+        self.segment_keys = sorted(self.by_segment)
+        self.code_keys = sorted(self.by_code)
+        self.value_keys = sorted(self.by_value)
+        self.segments = sorted({element['segment_tag'] for element in elements})
+    
+    @staticmethod
+    def _prefix_ids(postings, sorted_keys, prefix):
+        start = bisect.bisect_left(sorted_keys, prefix)
+        matched = []
+        for key in sorted_keys[start:]:
+            if not key.startswith(prefix):
+                break
+            matched.append(postings[key])
+        if len(matched) == 1:
+            return matched[0]
+        return sorted(set().union(*matched))
+    
+    def _lookup(self, postings, sorted_keys, value, match):
+        if match == 'prefix':
+            return self._prefix_ids(postings, sorted_keys, value)
+        return postings.get(value, [])
+    
+    def query(self, segment=None, element_code=None, value=None, match='exact', line=None, q=None,
+              cursor=None, limit=50):
+        """Return (elements, next_cursor, total_matches) for the combined filters"""
+        # Each filter is a sorted posting list plus a per-element check, so the
+        # smallest list drives the scan and the other filters are checked directly
+        filters = []
+        if segment:
+            segment = segment.lower()
+            filters.append((self.by_segment.get(segment, []),
+                            lambda el: el['segment_tag'].lower() == segment))
+        if element_code:
+            element_code = element_code.lower()
+            filters.append((self.by_code.get(element_code, []),
+                            lambda el: el['element_code'].lower() == element_code))
+        if line is not None:
+            filters.append((self.by_line.get(line, []),
+                            lambda el: el['line_number'] == line))
+        if value:
+            value = value.lower()
+            if match == 'prefix':
+                check = lambda el: el['element_value'].lower().startswith(value)
+            else:
+                check = lambda el: el['element_value'].lower() == value
+            filters.append((self._lookup(self.by_value, self.value_keys, value, match), check))
+        if q:
+            q = q.lower()
+            ids = set(self._prefix_ids(self.by_value, self.value_keys, q))
+            ids.update(self._prefix_ids(self.by_code, self.code_keys, q))
+            ids.update(self._prefix_ids(self.by_segment, self.segment_keys, q))
+            filters.append((sorted(ids), lambda el: (
+                el['element_value'].lower().startswith(q) or
+                el['element_code'].lower().startswith(q) or
+                el['segment_tag'].lower().startswith(q))))
+        
+        if not filters:
+            matched_ids = range(len(self.elements))
+        else:
+            filters.sort(key=lambda f: len(f[0]))
+            driving_ids, _ = filters[0]
+            checks = [check for _, check in filters[1:]]
+            if checks:
+                matched_ids = [i for i in driving_ids if all(check(self.elements[i]) for check in checks)]
+            else:
+                matched_ids = driving_ids
+        
+        start = bisect.bisect_right(matched_ids, cursor) if cursor is not None else 0
+        page_ids = matched_ids[start:start + limit]
+        next_cursor = page_ids[-1] if start + limit < len(matched_ids) and page_ids else None
+        
+        page = [dict(self.elements[i], element_id=i) for i in page_ids]
+        return page, next_cursor, len(matched_ids)
+
+# Segments that close a PO1 loop, so they are not keyed to the last line item
+LOOP_END_SEGMENTS = {'CTT', 'SE', 'GE', 'IEA'}
+
+def group_edi_segments(edi_data):
+    """Group segments by transaction and PO1 line, keeping file order within each group"""
+    groups = {}
+    transaction = None
+    po1_line = None
+    group = groups.setdefault((transaction, po1_line), [])
+    segment_count = 0
+    
+    for line_num, line in iter_edi_lines(edi_data):
+        line = line.strip()
+        if '~' not in line:
+            continue
+        # Only the tag is needed to group a segment; elements are split for ST/PO1
+        # here and for modified segments later
+        segment_tag, separator, _ = line.partition('*')
+        if not separator:
+            continue
+        
+        # The group only changes at ST, PO1 and loop-closing segments
+        if segment_tag == 'ST':
+            elements = line.rstrip('~').split('*', 3)
+            transaction = elements[2] if len(elements) > 2 else ''
+            po1_line = None
+            group = groups.setdefault((transaction, po1_line), [])
+        elif segment_tag == 'PO1':
+            elements = line.rstrip('~').split('*', 2)
+            po1_line = elements[1] if len(elements) > 1 else ''
+            group = groups.setdefault((transaction, po1_line), [])
+        elif segment_tag in LOOP_END_SEGMENTS and po1_line is not None:
+            po1_line = None
+            group = groups.setdefault((transaction, po1_line), [])
+        
+        group.append((line_num, line, segment_tag))
+        segment_count += 1
+    
+    if not groups[(None, None)]:
+        del groups[(None, None)]
+    return groups, segment_count
+
+def diff_segment_elements(segment_tag, original_elements, corrected_elements):
+    """Compare two versions of a segment element by element"""
+    changes = []
+    for i in range(1, max(len(original_elements), len(corrected_elements))):
+        original_value = original_elements[i] if i < len(original_elements) else None
+        corrected_value = corrected_elements[i] if i < len(corrected_elements) else None
+        if original_value != corrected_value:
+            changes.append({
+                "element_code": f'{segment_tag}{i:02d}',
+                "element_description": get_element_description(segment_tag, i, corrected_value),
+                "original_value": original_value,
+                "corrected_value": corrected_value
+            })
+    return changes
+
+def pair_replaced_segments(old_block, new_block):
+    """Pair the segments of a replace block by tag and occurrence; the rest are unpaired"""
+    new_by_tag = defaultdict(list)
+    for segment in new_block:
+        new_by_tag[segment[2]].append(segment)
+    for tag_segments in new_by_tag.values():
+        tag_segments.reverse()
+    
+    pairs, unpaired_old = [], []
+    for segment in old_block:
+        candidates = new_by_tag.get(segment[2])
+        if candidates:
+            pairs.append((segment, candidates.pop()))
+        else:
+            unpaired_old.append(segment)
+    paired_new = {id(new) for _, new in pairs}
+    unpaired_new = [segment for segment in new_block if id(segment) not in paired_new]
+    return pairs, unpaired_old, unpaired_new
+
+def diff_edi_interchanges(original_edi, corrected_edi):
+    """Diff two EDI interchanges by aligning the segment sequence of each transaction/PO1 loop"""
+    original, original_count = group_edi_segments(original_edi)
+    corrected, corrected_count = group_edi_segments(corrected_edi)
+    
+    added, removed, modified, moved = [], [], [], []
+    unchanged = 0
+    
+    for group_key in original.keys() | corrected.keys():
+        transaction, po1_line = group_key
+        old_segments = original.get(group_key, [])
+        new_segments = corrected.get(group_key, [])
+        old_lines = [s[1] for s in old_segments]
+        new_lines = [s[1] for s in new_segments]
+        
+        # Most loops of a corrected re-send are untouched; skip the matcher for them
+        if old_lines == new_lines:
+            unchanged += len(old_lines)
+            continue
+        
+        # Align whole segment lines; SequenceMatcher indexes them in a dict, so the
+        # alignment is near-linear for the short, mostly-unique sequences of a loop
+        matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+        group_removed, group_added = [], []
+        for opcode, i1, i2, j1, j2 in matcher.get_opcodes():
+            if opcode == 'equal':
+                unchanged += i2 - i1
+                continue
+            pairs, unpaired_old, unpaired_new = pair_replaced_segments(
+                old_segments[i1:i2], new_segments[j1:j2])
+            for (old_line_num, old_line, segment_tag), (new_line_num, new_line, _) in pairs:
+                modified.append({
+                    "segment": segment_tag,
+                    "transaction_control_number": transaction,
+                    "po1_line_number": po1_line,
+                    "original_line": old_line_num,
+                    "corrected_line": new_line_num,
+                    "original_raw_data": old_line,
+                    "corrected_raw_data": new_line,
+                    "element_changes": diff_segment_elements(
+                        segment_tag, old_line.rstrip('~').split('*'), new_line.rstrip('~').split('*'))
+                })
+            group_removed.extend(unpaired_old)
+            group_added.extend(unpaired_new)
+        
+        # A segment removed in one place and added unchanged in another was reordered
+        added_by_line = defaultdict(list)
+        for segment in reversed(group_added):
+            added_by_line[segment[1]].append(segment)
+        for old_line_num, old_line, segment_tag in group_removed:
+            same_line = added_by_line.get(old_line)
+            if same_line:
+                new_line_num = same_line.pop()[0]
+                moved.append({
+                    "segment": segment_tag,
+                    "transaction_control_number": transaction,
+                    "po1_line_number": po1_line,
+                    "original_line": old_line_num,
+                    "corrected_line": new_line_num,
+                    "raw_data": old_line
+                })
+            else:
+                removed.append({
+                    "segment": segment_tag,
+                    "transaction_control_number": transaction,
+                    "po1_line_number": po1_line,
+                    "original_line": old_line_num,
+                    "raw_data": old_line
+                })
+        for segments in added_by_line.values():
+            for new_line_num, new_line, segment_tag in reversed(segments):
+                added.append({
+                    "segment": segment_tag,
+                    "transaction_control_number": transaction,
+                    "po1_line_number": po1_line,
+                    "corrected_line": new_line_num,
+                    "raw_data": new_line
+                })
+    
+    # Loops that exist in both files but whose relative order changed
+    common = [key for key in original if key in corrected]
+    corrected_order = [key for key in corrected if key in original]
+    if common == corrected_order:
+        in_order = set(common)
+    else:
+        loop_matcher = difflib.SequenceMatcher(None, common, corrected_order, autojunk=False)
+        in_order = set()
+        for block in loop_matcher.get_matching_blocks():
+            in_order.update(common[block.a:block.a + block.size])
+    moved_loops = [{
+        "transaction_control_number": key[0],
+        "po1_line_number": key[1],
+        "original_line": original[key][0][0],
+        "corrected_line": corrected[key][0][0]
+    } for key in common if key not in in_order]
+    
+    order = operator.itemgetter('original_line')
+    removed.sort(key=order)
+    modified.sort(key=order)
+    moved.sort(key=order)
+    added.sort(key=operator.itemgetter('corrected_line'))
+    
+    return {
+        "summary": {
+            "original_segments": original_count,
+            "corrected_segments": corrected_count,
+            "unchanged": unchanged,
+            "added": len(added),
+            "removed": len(removed),
+            "modified": len(modified),
+            "moved": len(moved),
+            "moved_loops": len(moved_loops)
+        },
+        "added": added,
+        "removed": removed,
+        "modified": modified,
+        "moved": moved,
+        "moved_loops": moved_loops
+    }
+
+# Only one deterministic profiler can be active per process at a time
+profiler_lock = threading.Lock()
+
+def profile_thread_task(fn):
+    """Wrap fn so a pool thread running it is profiled too while the current request is profiled"""
+    if not has_request_context() or g.get('profiler') is None:
+        return fn
+    import cProfile
+    
+    # The request thread's profiler only sees future.result() waits; each task
+    # gets its own profiler and the request merges them when it saves the profile
+    thread_profilers = g.setdefault('thread_profilers', [])
+    
+    def run(*args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can be active per interpreter on Python 3.12+
+            return fn(*args, **kwargs)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            thread_profilers.append(profiler)
+    return run
+
+def summarize_profile(stats, top_n=30, tree_depth=8, min_fraction=0.01):
+    """Build the top functions and a call tree from pstats.Stats"""
+    def label(func):
+        filename, line, name = func
+        return f'{name} ({os.path.basename(filename)}:{line})' if line else name
+    
+    total_time = stats.total_tt or 1e-9
+    top_functions = []
+    for func, (cc, nc, tt, ct, callers) in sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top_n]:
+        top_functions.append({
+            "function": label(func),
+            "calls": nc,
+            "primitive_calls": cc,
+            "own_time_ms": round(tt * 1000, 3),
+            "cumulative_time_ms": round(ct * 1000, 3)
+        })
+    
+    # pstats records callers per function; invert it to walk callees from the roots
+    callees = defaultdict(list)
+    roots = []
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            roots.append(func)
+        for caller, caller_stats in callers.items():
+            callees[caller].append((func, caller_stats[3]))
+    
+    def build(func, cumulative, depth, path):
+        node = {"function": label(func), "cumulative_time_ms": round(cumulative * 1000, 3), "children": []}
+        if depth < tree_depth:
+            for child, child_cumulative in sorted(callees[func], key=lambda c: c[1], reverse=True):
+                if child in path or child_cumulative < total_time * min_fraction:
+                    continue
+                node["children"].append(build(child, child_cumulative, depth + 1, path | {child}))
+        return node
+    
+    call_tree = [build(func, stats.stats[func][3], 0, {func}) for func in roots
+                 if stats.stats[func][3] >= total_time * min_fraction]
+    call_tree.sort(key=lambda node: node["cumulative_time_ms"], reverse=True)
+    
+    return {"total_time_ms": round(total_time * 1000, 3), "top_functions": top_functions, "call_tree": call_tree}
+
+def save_profile(profiler, method, path, duration, thread_profilers=()):
+    """Write a finished profile as .prof plus a JSON summary, pruning old ones
+
+    Profiles of pool-thread tasks are merged in, so total_time_ms can exceed
+    request_time_ms when work overlapped.
+    """
+    import pstats
+    
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile_id = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    stats = pstats.Stats(profiler)
+    for thread_profiler in thread_profilers:
+        stats.add(thread_profiler)
+    stats.dump_stats(os.path.join(PROFILE_DIR, f'{profile_id}.prof'))
+    
+    summary = summarize_profile(stats)
+    summary.update({
+        "profile_id": profile_id,
+        "method": method,
+        "path": path,
+        "request_time_ms": round(duration * 1000, 3),
+        "thread_tasks_profiled": len(thread_profilers),
+        "profiled_at": datetime.now().isoformat()
+    })
+    with open(os.path.join(PROFILE_DIR, f'{profile_id}.json'), 'w') as f:
+        json.dump(summary, f)
+    
+    saved = sorted(name[:-5] for name in os.listdir(PROFILE_DIR) if name.endswith('.json'))
+    for old_id in saved[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else []:
+        for extension in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old_id + extension))
+            except OSError:
+                pass
+    return profile_id
+
+def register_profiling(app):
+    """Attach the profiling hooks and routes; only called when profiling is enabled"""
+    import cProfile
+    
+    def profile_token_valid(header):
+        supplied = request.headers.get(header)
+        return bool(PROFILE_TOKEN) and supplied is not None and hmac.compare_digest(
+            supplied.encode('utf-8'), PROFILE_TOKEN.encode('utf-8'))
+    
+    @app.before_request
+    def start_profiler():
+        if request.path.startswith('/api/profiles') or request.path.startswith('/static'):
+            return
+        requested = profile_token_valid('X-Profile')
+        if not requested and not (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE):
+            return
+        if not profiler_lock.acquire(blocking=False):
+            return
+        g.profiler = cProfile.Profile()
+        g.profile_started = time.perf_counter()
+        g.profiler.enable()
+    
+    @app.after_request
+    def stop_profiler(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        try:
+            profiler.disable()
+            profile_id = save_profile(profiler, request.method, request.path,
+                                      time.perf_counter() - g.pop('profile_started'),
+                                      g.pop('thread_profilers', []))
+            response.headers['X-Profile-Id'] = profile_id
+        except Exception as e:
+            print(f"Failed to save request profile: {e}")
+        finally:
+            profiler_lock.release()
+        return response
+    
+    @app.teardown_request
+    def release_profiler(error=None):
+        # after_request does not run when a view raises; make sure the profiler stops
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            profiler_lock.release()
+    
+    @app.route('/api/profiles')
+    def list_profiles():
+        """List saved request profiles"""
+        if not profile_token_valid('X-Profile-Token'):
+            return jsonify({"error": "Valid X-Profile-Token header required"}), 403
+        
+        profiles = []
+        if os.path.isdir(PROFILE_DIR):
+            for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+                if name.endswith('.json'):
+                    with open(os.path.join(PROFILE_DIR, name)) as f:
+                        summary = json.load(f)
+                    profiles.append({key: summary.get(key) for key in
+                                     ("profile_id", "method", "path", "request_time_ms", "profiled_at")})
+        return jsonify({"profiles": profiles, "total_profiles": len(profiles)})
+    
+    @app.route('/api/profiles/<profile_id>')
+    def get_profile(profile_id):
+        """Return a saved profile summary, or the raw pstats file with ?format=prof"""
+        if not profile_token_valid('X-Profile-Token'):
+            return jsonify({"error": "Valid X-Profile-Token header required"}), 403
+        if not re.fullmatch(r'[0-9T]+-[0-9a-f]{8}', profile_id):
+            return jsonify({"error": "Invalid profile id"}), 400
+        
+        extension = '.prof' if request.args.get('format') == 'prof' else '.json'
+        profile_path = os.path.join(PROFILE_DIR, profile_id + extension)
+        if not os.path.exists(profile_path):
+            return jsonify({"error": "Profile not found"}), 404
+        if extension == '.prof':
+            return send_file(profile_path, mimetype='application/octet-stream',
+                             as_attachment=True, download_name=f'{profile_id}.prof')
+        with open(profile_path) as f:
+            return jsonify(json.load(f))
+
 def create_app():
 
     app = Flask(__name__, static_folder='static')
     
+    # Reject oversized request bodies before they are read
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+    
+    @app.before_request
+    def reject_oversized_uploads():
+        if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+            return request_too_large(None)
+    
+    @app.errorhandler(413)
+    def request_too_large(error):
+        return jsonify({"error": f"Upload exceeds the maximum allowed size of {app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
+    
     # Add CORS headers manually
     @app.after_request
     def after_request(response):
@@ -659,6 +2906,10 @@ def create_app():
         response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
         return response
     
+    # Profiling hooks are only registered when enabled, so they cost nothing otherwise
+    if PROFILING_ENABLED:
+        register_profiling(app)
+    
     @app.route('/options-workaround', methods=['OPTIONS'])
     def handle_options():
         return '', 200
@@ -723,7 +2974,11 @@ def create_app():
                 return jsonify({"error": "Invalid PDF file"}), 400
             
             # Extract PDF text
-            pdf_text = extract_pdf_text(pdf_file)
+            pdf_text, extraction_stats = extract_pdf_text_with_stats(
+                pdf_file,
+                prescreen=request.form.get('prescreen', 'true').lower() != 'false',
+                word_rows=request.form.get('word_rows', 'false').lower() == 'true'
+            )
             all_lines = [line.strip() for line in pdf_text.splitlines() if line.strip()]
             
             # Filter lines
@@ -745,7 +3000,8 @@ def create_app():
                 "filtered_lines_count": len(filtered_lines),
                 "filtered_lines": filtered_lines[:20],  # Show first 20 for debugging
                 "segments_found": sorted(list(segments_found)),
-                "missing_segments": sorted(list(set(EDI_SEGMENTS) - segments_found))
+                "missing_segments": sorted(list(set(EDI_SEGMENTS) - segments_found)),
+                "pdf_extraction": extraction_stats
             })
             
         except Exception as e:
@@ -763,58 +3019,87 @@ def create_app():
             if pdf_file.filename == '' or not pdf_file.filename.lower().endswith('.pdf'):
                 return jsonify({"error": "Invalid PDF file"}), 400
             
+            # 'ai' sends filtered lines to the AI endpoint; 'offline' reads the
+            # segment table from PDF coordinates and makes no network calls
+            mode = request.form.get('mode', 'ai').lower()
+            if mode not in ('ai', 'offline'):
+                return jsonify({"error": "mode must be 'ai' or 'offline'"}), 400
+            prescreen = request.form.get('prescreen', 'true').lower() != 'false'
+            # Callers that page through /api/uploads/<id>/elements can skip the full element list
+            include_elements = request.form.get('include_elements', 'true').lower() != 'false'
+
             # Check if EDI data TXT file is provided
             edi_segments_present = []
+            segment_counts = {}
             edi_elements_data = []
-            if 'edi_data' in request.files:
-                edi_file = request.files['edi_data']
-                if edi_file.filename != '' and edi_file.filename.lower().endswith('.txt'):
-                    # Read EDI data from TXT file
-                    edi_data = edi_file.read().decode('utf-8').strip()
-                    if edi_data:
-                        # Store the uploaded EDI data globally
-                        uploaded_edi_data = edi_data
-                        print(f"Stored uploaded EDI data: {edi_data[:100]}...")  # Log first 100 chars
-                        
-                        # Extract segment tags from EDI data
-                        edi_lines = edi_data.splitlines()
-                        for line in edi_lines:
-                            line = line.strip()
-                            if line and '*' in line:
-                                segment_tag = line.split('*')[0]
-                                if segment_tag and segment_tag not in edi_segments_present:
-                                    edi_segments_present.append(segment_tag)
-                        
-                        # Parse EDI elements
-                        edi_elements_data = parse_edi_elements(edi_data)
-            
-            # Extract and filter PDF text
-            pdf_text = extract_pdf_text(pdf_file)
-            filtered_lines = filter_edi_lines(pdf_text)
+            total_elements = 0
+            element_validation = None
+            upload_id = None
+            duplicate = None
+            
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as edi_executor:
+                edi_future = None
+                if 'edi_data' in request.files:
+                    edi_file = request.files['edi_data']
+                    if edi_file.filename != '' and edi_file.filename.lower().endswith('.txt'):
+                        # Read EDI data from TXT file
+                        edi_data = read_edi_upload(edi_file)
+                        if edi_has_content(edi_data):
+                            # Store the uploaded EDI data globally
+                            uploaded_edi_data = edi_data
+                            print(f"Stored uploaded EDI data: {edi_preview(edi_data)}...")  # Log first 100 chars
+                            
+                            # Tokenize once for segment presence, validation and (when
+                            # returned inline) the elements while the PDF pipeline runs; a
+                            # resubmitted interchange is served its stored analysis instead
+                            parts = ('element_validation', 'elements') if include_elements else ('element_validation',)
+                            edi_future = edi_executor.submit(profile_thread_task(analyze_edi_once), edi_data, parts)
+                
+                # Pages flow through the line filter and each full chunk of
+                # filtered lines goes to the AI while later pages are laid out;
+                # offline mode reads the spec table from the same laid-out pages
+                offline_result = {}
+                filtered_lines, ai_results, extraction_stats = run_spec_pipeline(
+                    pdf_file,
+                    prescreen=prescreen,
+                    word_rows=request.form.get('word_rows', 'false').lower() == 'true',
+                    use_ai=mode == 'ai',
+                    on_page=(lambda page: merge_spec_rows(offline_result, extract_page_spec_rows(page)))
+                    if mode == 'offline' else None
+                )
+                
+                if edi_future is not None:
+                    # Keep the analysis with the upload for later routes
+                    analysis, duplicate = edi_future.result()
+                    edi_segments_present = analysis["segments_present"]
+                    segment_counts = analysis["segment_counts"]
+                    edi_elements_data = analysis.get("elements", []) if include_elements else []
+                    total_elements = analysis["element_count"]
+                    element_validation = truncate_validation(analysis["element_validation"], 500)
+                    upload_id = store_uploaded_edi(edi_data, edi_file.filename, analysis)
             
-            if not filtered_lines:
+            if not filtered_lines and not offline_result:
                 return jsonify({"error": "No EDI specification lines found in PDF"}), 400
             
             # Build local fallback result
             local_result = build_local_segment_dict(filtered_lines)
             
-            # Process in chunks with AI
-            ai_results = []
-            chunks = list(chunk_iter(filtered_lines, 5))
-            
-            for chunk in chunks:
-                ai_response = call_ai_endpoint_chunk(chunk)
-                ai_results.append(ai_response)
-            
-            # Merge AI results with local fallback
-            final_result = merge_results(ai_results, local_result)
+            if mode == 'offline':
+                # The coordinate extractor takes priority over the text heuristics
+                final_result = merge_results([offline_result], local_result)
+            else:
+                # Merge AI results with local fallback
+                final_result = merge_results(ai_results, local_result)
             
             # Create tabular data for display
             tabular_data = []
             for segment, spec in final_result.items():
-                is_present = segment in edi_segments_present
-                # Set max_usage: >1 for REF segments, 1 for others
-                max_usage_display = ">1" if segment == "REF" else "1"
+                is_present = segment in segment_counts
+                # Offline mode reads max use from the table; otherwise >1 for REF segments, 1 for others
+                if mode == 'offline' and spec.get("max_usage") is not None:
+                    max_usage_display = str(spec["max_usage"])
+                else:
+                    max_usage_display = ">1" if segment == "REF" else "1"
                 tabular_data.append({
                     "segment_tag": segment,
                     "x12_requirement": spec.get("x12_requirement", "unknown"),
@@ -829,13 +3114,19 @@ def create_app():
             
             return jsonify({
                 "message": "EDI specification analysis completed",
+                "mode": mode,
                 "total_lines": len(filtered_lines),
-                "chunks_processed": len(chunks),
+                "chunks_processed": len(ai_results),
                 "segments_in_edi": edi_segments_present,
+                "segment_counts": segment_counts,
                 "segment_specifications": final_result,
                 "tabular_data": tabular_data,
+                "upload_id": upload_id,
                 "edi_elements": edi_elements_data,
-                "total_elements": len(edi_elements_data)
+                "total_elements": total_elements,
+                "element_validation": element_validation,
+                "duplicate_interchange": duplicate,
+                "pdf_extraction": extraction_stats
             })
             
         except Exception as e:
@@ -864,12 +3155,13 @@ def create_app():
                 return jsonify({"error": "Invalid TXT file"}), 400
             
             # Read EDI data from TXT file
-            edi_data = txt_file.read().decode('utf-8').strip()
-            if not edi_data:
+            edi_data = read_edi_upload(txt_file)
+            if not edi_has_content(edi_data):
                 return jsonify({"error": "TXT file is empty or contains no EDI data"}), 400
             
             #parse pdf line by line 
             def extract_pdf_text(pdf_file):
+                import pdfplumber
                 pdf_text = ""
                 with pdfplumber.open(pdf_file) as pdf:
                     for page in pdf.pages:
@@ -879,9 +3171,7 @@ def create_app():
             pdf_text = extract_pdf_text(pdf_file)
 
             # read text file line by line
-            edi_lines = edi_data.splitlines()
-            edi_segments = [line for line in edi_lines if line.strip()]
-            segment_tags = [line.split('*')[0] for line in edi_segments if '*' in line]
+            segment_tags = list(iter_segment_tags(edi_data))
 
             pdf_lines = pdf_text.splitlines()
             pdf_segments = [line for line in pdf_lines if line.strip()]
@@ -912,19 +3202,211 @@ def create_app():
                 if edi_file.filename == '' or not edi_file.filename.lower().endswith('.txt'):
                     return jsonify({"error": "Invalid EDI file. Please upload a .txt file"}), 400
                 
-                edi_data = edi_file.read().decode('utf-8').strip()
+                edi_data = read_edi_upload(edi_file)
             
-            if not edi_data:
+            if not edi_data or not edi_has_content(edi_data):
                 return jsonify({"error": "No EDI data provided"}), 400
             
-            # Convert EDI to JSON
-            json_result = convert_edi_to_json(edi_data)
+            # Sparse fieldsets: ?fields=line_items,summary or a JSON 'fields' list
+            fields = request.args.get('fields')
+            if fields is None and request.is_json:
+                fields = data.get('fields')
+            try:
+                fields = parse_fields_param(fields)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
             
-            return jsonify({
+            # ?parallel=true|false overrides the size-based choice of parallel parsing
+            parallel = request.args.get('parallel')
+            if parallel is None and request.is_json:
+                parallel = data.get('parallel')
+            
+            identity, entry, reused = find_duplicate_interchange(edi_data)
+            payload = {
                 "message": "EDI successfully converted to JSON",
                 "conversion_date": datetime.now().isoformat(),
                 "original_edi_length": len(edi_data),
-                "json_data": json_result
+                "duplicate_interchange": describe_duplicate(identity, entry, reused)
+            }
+            
+            # A resubmitted interchange is served the JSON stored when it was first analyzed
+            if entry is not None and entry["analysis"] is not None and "json" in entry["analysis"]:
+                return jsonify({**payload, "json_data": project_edi_json(entry["analysis"]["json"], fields)})
+            
+            # Only the identity is recorded: the JSON here may be a projection, and
+            # the full analysis is stored by the upload routes
+            if entry is None:
+                record_interchange(identity)
+            
+            # Convert EDI to JSON
+            return edi_json_response(payload, edi_data, fields, parse_parallel_param(parallel))
+            
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/diff-edi', methods=['POST'])
+    def diff_edi():
+        """Compare an original EDI interchange against a corrected re-send"""
+        try:
+            if request.is_json:
+                data = request.get_json(silent=True)
+                if not isinstance(data, dict):
+                    return jsonify({"error": "Request body must be a JSON object"}), 400
+                original_edi = data.get('original_edi', '')
+                corrected_edi = data.get('corrected_edi', '')
+                if not isinstance(original_edi, str) or not isinstance(corrected_edi, str):
+                    return jsonify({"error": "'original_edi' and 'corrected_edi' must be strings"}), 400
+            else:
+                if 'original_file' not in request.files or 'corrected_file' not in request.files:
+                    return jsonify({"error": "Both 'original_file' and 'corrected_file' uploads are required"}), 400
+                
+                original_file = request.files['original_file']
+                corrected_file = request.files['corrected_file']
+                if original_file.filename == '' or corrected_file.filename == '':
+                    return jsonify({"error": "No file selected"}), 400
+                
+                original_edi = read_edi_upload(original_file)
+                corrected_edi = read_edi_upload(corrected_file)
+            
+            if not edi_has_content(original_edi) or not edi_has_content(corrected_edi):
+                return jsonify({"error": "Both EDI interchanges must contain data"}), 400
+            
+            diff_result = diff_edi_interchanges(original_edi, corrected_edi)
+            
+            return jsonify({
+                "message": "EDI interchanges compared successfully",
+                "comparison_date": datetime.now().isoformat(),
+                "diff": diff_result
+            })
+            
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/api/ai-metrics')
+    def ai_metrics():
+        """Return AI admission control counters"""
+        return jsonify({
+            "message": "AI admission metrics",
+            "limits": {
+                "rate_per_second": ai_admission.rate,
+                "burst": ai_admission.burst,
+                "max_concurrency": ai_admission.max_concurrency,
+                "admission_timeout": AI_ADMISSION_TIMEOUT
+            },
+            "admission": ai_admission.get_metrics()
+        })
+
+    @app.route('/api/line-item-analytics', methods=['GET', 'POST'])
+    def line_item_analytics():
+        """Aggregate PO1/ACK totals for an 855, or for the last uploaded EDI on GET"""
+        try:
+            if request.method == 'GET':
+                edi_data = uploaded_edi_data
+                if not edi_data:
+                    return jsonify({
+                        "error": "No EDI data uploaded",
+                        "message": "Please upload an EDI file first"
+                    }), 404
+            elif request.is_json:
+                edi_data = request.get_json().get('edi_data', '')
+            else:
+                if 'edi_file' not in request.files:
+                    return jsonify({"error": "EDI data required either as JSON 'edi_data' field or as 'edi_file' upload"}), 400
+                edi_data = read_edi_upload(request.files['edi_file'])
+            
+            if not edi_data or not edi_has_content(edi_data):
+                return jsonify({"error": "No EDI data provided"}), 400
+            
+            mismatch_limit = request.args.get('mismatch_limit', 100, type=int)
+            started = time.perf_counter()
+            columns = get_cached_analysis_part(edi_data, "line_item_columns") if request.method == 'GET' else None
+            if columns is None:
+                columns = build_line_item_columns(edi_data)
+            analytics = compute_line_item_analytics(columns, mismatch_limit)
+            
+            return jsonify({
+                "message": "Line item analytics computed",
+                "analysis_time_ms": round((time.perf_counter() - started) * 1000, 2),
+                "analytics": analytics
+            })
+            
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/validate-elements', methods=['GET', 'POST'])
+    def validate_elements():
+        """Check element values against X12 data types, lengths and code lists"""
+        try:
+            if request.method == 'GET':
+                edi_data = uploaded_edi_data
+                if not edi_data:
+                    return jsonify({
+                        "error": "No EDI data uploaded",
+                        "message": "Please upload an EDI file first"
+                    }), 404
+            elif request.is_json:
+                edi_data = request.get_json().get('edi_data', '')
+            else:
+                if 'edi_file' not in request.files:
+                    return jsonify({"error": "EDI data required either as JSON 'edi_data' field or as 'edi_file' upload"}), 400
+                edi_data = read_edi_upload(request.files['edi_file'])
+            
+            if not edi_data or not edi_has_content(edi_data):
+                return jsonify({"error": "No EDI data provided"}), 400
+            
+            limit = request.args.get('limit', 1000, type=int)
+            started = time.perf_counter()
+            report = get_cached_analysis_part(edi_data, "element_validation") if request.method == 'GET' else None
+            if report is not None:
+                validation = truncate_validation(report, limit)
+            else:
+                validation = validate_edi_elements(edi_data, limit=limit)
+            
+            return jsonify({
+                "message": "EDI element validation completed",
+                "validation_time_ms": round((time.perf_counter() - started) * 1000, 2),
+                "valid": validation["violation_count"] == 0,
+                "validation": validation
+            })
+            
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    @app.route('/api/uploads/<upload_id>/elements')
+    def query_uploaded_elements(upload_id):
+        """Page through the parsed elements of a stored upload using the element index"""
+        try:
+            upload = get_uploaded_edi(upload_id)
+            if upload is None:
+                return jsonify({
+                    "error": "Upload not found",
+                    "message": "Please upload an EDI file first"
+                }), 404
+            
+            match = request.args.get('match', 'exact')
+            if match not in ('exact', 'prefix'):
+                return jsonify({"error": "match must be 'exact' or 'prefix'"}), 400
+            limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+            
+            index = get_element_index(upload)
+            elements, next_cursor, total_matches = index.query(
+                segment=request.args.get('segment'),
+                element_code=request.args.get('element_code'),
+                value=request.args.get('value'),
+                match=match,
+                line=request.args.get('line', type=int),
+                q=request.args.get('q'),
+                cursor=request.args.get('cursor', type=int),
+                limit=limit
+            )
+            
+            return jsonify({
+                "upload_id": upload["upload_id"],
+                "elements": elements,
+                "next_cursor": next_cursor,
+                "total_matches": total_matches,
+                "total_elements": len(index.elements),
+                "segments": index.segments
             })
             
         except Exception as e:
@@ -968,13 +3450,23 @@ IEA*1*000122406~"""
                 "message": "Please upload an EDI file first"
             }), 404
         
-        json_result = convert_edi_to_json(uploaded_edi_data)
+        try:
+            fields = parse_fields_param(request.args.get('fields'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        return jsonify({
+        payload = {
             "message": "Uploaded EDI data converted to JSON",
-            "original_edi": uploaded_edi_data,
-            "json_data": json_result
-        })
+            "original_edi": edi_to_text(uploaded_edi_data)
+        }
+        
+        # Serve the JSON built when the upload was analyzed instead of parsing again
+        json_result = get_cached_analysis_part(uploaded_edi_data, "json", build=False)
+        if json_result is not None:
+            return jsonify({**payload, "json_data": project_edi_json(json_result, fields)})
+        
+        return edi_json_response(payload, uploaded_edi_data, fields,
+                                 parse_parallel_param(request.args.get('parallel')))
     
     @app.route('/upload-edi-direct', methods=['POST'])
     def upload_edi_direct():
@@ -990,22 +3482,40 @@ IEA*1*000122406~"""
                 return jsonify({"error": "No file selected"}), 400
             
             # Read EDI data
-            edi_data = edi_file.read().decode('utf-8').strip()
-            if not edi_data:
+            edi_data = read_edi_upload(edi_file)
+            if not edi_has_content(edi_data):
                 return jsonify({"error": "Empty EDI file"}), 400
             
             # Store the EDI data globally
             uploaded_edi_data = edi_data
-            print(f"Direct upload - Stored EDI data: {edi_data[:100]}...")
+            print(f"Direct upload - Stored EDI data: {edi_preview(edi_data)}...")
             
-            # Convert to JSON
-            json_result = convert_edi_to_json(edi_data)
+            # Large files are converted across the process pool unless they are
+            # a known duplicate; anything else is analyzed in one pass (or served
+            # its stored analysis) and cached with the upload
+            if use_parallel_parse(edi_data):
+                identity, entry, reused = find_duplicate_interchange(edi_data)
+                analysis = entry["analysis"] if entry else None
+                duplicate = describe_duplicate(identity, entry, reused)
+                if entry is None:
+                    record_interchange(identity)
+            else:
+                # Only the JSON is returned; elements and validation are built
+                # on first use by the routes that serve them
+                analysis, duplicate = analyze_edi_once(edi_data, ('json',))
+            upload_id = store_uploaded_edi(edi_data, edi_file.filename, analysis)
             
-            return jsonify({
+            payload = {
                 "message": "EDI file uploaded successfully",
                 "filename": edi_file.filename,
-                "json_data": json_result
-            })
+                "upload_id": upload_id,
+                "duplicate_interchange": duplicate
+            }
+            if analysis is None or "json" not in analysis:
+                return edi_json_response(payload, edi_data, parallel=True)
+            
+            # Convert to JSON
+            return jsonify({**payload, "json_data": analysis["json"]})
             
         except Exception as e:
             return jsonify({"error": f"Upload failed: {str(e)}"}), 500
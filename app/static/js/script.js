@@ -165,9 +165,10 @@ async function analyzePDF() {
         const formData = new FormData();
         formData.append('pdf', pdfInput.files[0]);
         
-        // Add EDI data file if selected
+        // Add EDI data file if selected; its elements are paged from the server
         if (ediInput.files[0]) {
             formData.append('edi_data', ediInput.files[0]);
+            formData.append('include_elements', 'false');
         }
         
         const response = await fetch(`${API_BASE}/analyze-spec`, {
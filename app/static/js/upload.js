@@ -6,6 +6,15 @@ let filteredElementsData = [];
 let sortDirection = {};
 let elementsSortDirection = {};
 
+// Server-side element paging for stored uploads
+const ELEMENTS_PAGE_SIZE = 100;
+let currentUploadId = null;
+let elementsCursors = [null];
+let elementsNextCursor = null;
+let elementsTotalMatches = 0;
+let elementsTotal = 0;
+let elementsSearchTimer = null;
+
 // Search functionality
 function searchSegments() {
     const searchTerm = document.getElementById('segment-search').value.toLowerCase();
@@ -196,6 +205,7 @@ function hideTabularResults() {
 
 // EDI Elements Table Functions
 function showElementsResults(elementsData) {
+    currentUploadId = null;
     currentElementsData = elementsData;
     filteredElementsData = [...elementsData];
     
@@ -216,14 +226,13 @@ function showElementsResults(elementsData) {
 }
 
 function populateElementsFilters(elementsData) {
+    // Get unique segments
+    populateSegmentFilter([...new Set(elementsData.map(el => el.segment_tag))].sort());
+}
+
+function populateSegmentFilter(segments) {
     const segmentFilter = document.getElementById('segment-filter');
-    const lineFilter = document.getElementById('line-filter');
     
-    // Get unique segments and lines
-    const segments = [...new Set(elementsData.map(el => el.segment_tag))].sort();
-    const lines = [...new Set(elementsData.map(el => el.line_number))].sort((a, b) => a - b);
-    
-    // Populate segment filter
     segmentFilter.innerHTML = '<option value="">All Segments</option>';
     segments.forEach(segment => {
         const option = document.createElement('option');
@@ -231,15 +240,82 @@ function populateElementsFilters(elementsData) {
         option.textContent = segment;
         segmentFilter.appendChild(option);
     });
+}
+
+// Show elements of a stored upload, fetching one page at a time from the server index;
+// if the upload cannot be loaded, show the inline element list instead when there is one
+async function showUploadedElements(uploadId, fallbackElements) {
+    currentUploadId = uploadId;
+    elementsCursors = [null];
+    
+    const hasFallback = Array.isArray(fallbackElements) && fallbackElements.length > 0;
+    const loaded = await fetchElementsPage(null, hasFallback);
+    if (!loaded) {
+        if (hasFallback) {
+            showElementsResults(fallbackElements);
+        }
+        return;
+    }
     
-    // Populate line filter
-    lineFilter.innerHTML = '<option value="">All Lines</option>';
-    lines.forEach(line => {
-        const option = document.createElement('option');
-        option.value = line;
-        option.textContent = `Line ${line}`;
-        lineFilter.appendChild(option);
-    });
+    document.getElementById('elements-search').value = '';
+    document.getElementById('line-filter').value = '';
+    
+    const elementsContainer = document.getElementById('elements-results');
+    elementsContainer.style.display = 'block';
+    elementsContainer.scrollIntoView({ behavior: 'smooth', block: 'start' });
+}
+
+async function fetchElementsPage(cursor, quiet = false) {
+    const params = new URLSearchParams({ limit: ELEMENTS_PAGE_SIZE });
+    const searchTerm = document.getElementById('elements-search').value.trim();
+    const segmentFilter = document.getElementById('segment-filter').value;
+    const lineFilter = document.getElementById('line-filter').value;
+    
+    if (searchTerm) params.set('q', searchTerm);
+    if (segmentFilter) params.set('segment', segmentFilter);
+    if (lineFilter) params.set('line', lineFilter);
+    if (cursor !== null) params.set('cursor', cursor);
+    
+    try {
+        const response = await fetch(`${API_BASE}/api/uploads/${currentUploadId}/elements?${params}`);
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || 'Failed to load elements');
+        }
+        
+        // Only the segment list of an unfiltered first page describes the whole upload
+        if (cursor === null && !searchTerm && !segmentFilter && !lineFilter) {
+            populateSegmentFilter(data.segments);
+        }
+        
+        currentElementsData = data.elements;
+        filteredElementsData = [...data.elements];
+        elementsNextCursor = data.next_cursor;
+        elementsTotalMatches = data.total_matches;
+        elementsTotal = data.total_elements;
+        
+        populateElementsTable(filteredElementsData);
+        updateElementsCount();
+        return true;
+    } catch (error) {
+        console.error('Error loading elements:', error);
+        if (!quiet) {
+            alert('Error loading elements: ' + error.message);
+        }
+        return false;
+    }
+}
+
+function nextElementsPage() {
+    if (elementsNextCursor === null) return;
+    elementsCursors.push(elementsNextCursor);
+    fetchElementsPage(elementsNextCursor);
+}
+
+function prevElementsPage() {
+    if (elementsCursors.length <= 1) return;
+    elementsCursors.pop();
+    fetchElementsPage(elementsCursors[elementsCursors.length - 1]);
 }
 
 function searchElements() {
@@ -260,6 +336,16 @@ function filterElementsTable() {
 }
 
 function filterAndDisplayElementsTable(searchTerm = '') {
+    // Stored uploads are filtered by the server; debounce while the user types
+    if (currentUploadId) {
+        clearTimeout(elementsSearchTimer);
+        elementsSearchTimer = setTimeout(() => {
+            elementsCursors = [null];
+            fetchElementsPage(null);
+        }, 250);
+        return;
+    }
+    
     const segmentFilter = document.getElementById('segment-filter').value;
     const lineFilter = document.getElementById('line-filter').value;
     
@@ -287,6 +373,27 @@ function filterAndDisplayElementsTable(searchTerm = '') {
 
 function updateElementsCount() {
     const countElement = document.getElementById('elements-count');
+    const pager = document.getElementById('elements-pager');
+    
+    if (currentUploadId) {
+        const first = (elementsCursors.length - 1) * ELEMENTS_PAGE_SIZE;
+        const last = first + filteredElementsData.length;
+        if (countElement) {
+            countElement.textContent = elementsTotalMatches === 0
+                ? `Showing 0 of ${elementsTotal} elements`
+                : `Showing ${first + 1}-${last} of ${elementsTotalMatches} matching elements (${elementsTotal} total)`;
+        }
+        if (pager) {
+            pager.style.display = 'inline-flex';
+            document.getElementById('elements-prev').disabled = elementsCursors.length <= 1;
+            document.getElementById('elements-next').disabled = elementsNextCursor === null;
+        }
+        return;
+    }
+    
+    if (pager) {
+        pager.style.display = 'none';
+    }
     if (countElement) {
         countElement.textContent = `Showing ${filteredElementsData.length} of ${currentElementsData.length} elements`;
     }
@@ -380,6 +487,7 @@ function populateElementsTable(data) {
 
 function hideElementsResults() {
     document.getElementById('elements-results').style.display = 'none';
+    currentUploadId = null;
     currentElementsData = [];
     filteredElementsData = [];
 }
@@ -469,8 +577,10 @@ function showResults(data) {
         showTabularResults(data.tabular_data);
     }
     
-    // If EDI elements data is available, show the elements table
-    if (data.edi_elements && Array.isArray(data.edi_elements) && data.edi_elements.length > 0) {
+    // Page stored uploads from the server; fall back to an inline element list
+    if (data.upload_id && data.total_elements > 0) {
+        showUploadedElements(data.upload_id, data.edi_elements);
+    } else if (data.edi_elements && Array.isArray(data.edi_elements) && data.edi_elements.length > 0) {
         showElementsResults(data.edi_elements);
     }
     
@@ -0,0 +1,112 @@
+"""Accuracy of the offline spec-table extractor on the fixture guides
+
+Each fixtures/spec_guides/<name>.pdf has a hand-checked <name>.expected.json.
+The offline coordinate extractor and the local text heuristics are scored
+against it; with --with-ai the AI path used by /analyze-spec is scored too,
+along with how often the offline and AI results agree.
+
+The bundled fixtures are synthetic guides generated for this extractor, so
+their scores show regressions, not accuracy on real partner guides.
+
+Usage: python bench_offline_accuracy.py [--with-ai] [--fixtures DIR]
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+from app import (build_local_segment_dict, extract_pdf_text, extract_spec_table, filter_edi_lines,
+                 merge_results, run_spec_pipeline)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIELDS = ('x12_requirement', 'company_usage', 'max_usage')
+DEFAULT_FIXTURES = os.path.join(ROOT, 'fixtures', 'spec_guides')
+
+
+def local_path(pdf_path):
+    with open(pdf_path, 'rb') as pdf_file:
+        return build_local_segment_dict(filter_edi_lines(extract_pdf_text(pdf_file)))
+
+
+def ai_path(pdf_path):
+    with open(pdf_path, 'rb') as pdf_file:
+        filtered_lines, ai_results, _ = run_spec_pipeline(pdf_file)
+    return merge_results(ai_results, build_local_segment_dict(filtered_lines))
+
+
+def offline_path(pdf_path):
+    with open(pdf_path, 'rb') as pdf_file:
+        return extract_spec_table(pdf_file)
+
+
+def normalize(value):
+    return str(value).replace(' ', '').lower() if value is not None else None
+
+
+def score(result, expected):
+    """Return (segments found, fields correct, fields total, extra segments) against expected"""
+    found = sum(1 for segment in expected if segment in result)
+    correct = sum(
+        1 for segment, spec in expected.items() for field in FIELDS
+        if normalize(result.get(segment, {}).get(field)) == normalize(spec[field])
+    )
+    return found, correct, len(expected) * len(FIELDS), len(set(result) - set(expected))
+
+
+def agreement(left, right):
+    shared = set(left) & set(right)
+    if not shared:
+        return 0, 0
+    same = sum(1 for segment in shared for field in FIELDS
+               if normalize(left[segment].get(field)) == normalize(right[segment].get(field)))
+    return same, len(shared) * len(FIELDS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--with-ai', action='store_true', help='also call the AI endpoint (network)')
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES)
+    args = parser.parse_args()
+
+    paths = {'offline': offline_path, 'local': local_path}
+    if args.with_ai:
+        paths['ai'] = ai_path
+
+    totals = {name: [0, 0, 0, 0, 0.0] for name in paths}
+    agree_total = [0, 0]
+    for pdf_path in sorted(glob.glob(os.path.join(args.fixtures, '*.pdf'))):
+        with open(pdf_path[:-4] + '.expected.json') as f:
+            expected = json.load(f)
+
+        results = {}
+        print(os.path.basename(pdf_path))
+        for name, run in paths.items():
+            started = time.perf_counter()
+            results[name] = run(pdf_path)
+            elapsed = time.perf_counter() - started
+            found, correct, total, extra = score(results[name], expected)
+            for i, value in enumerate((found, correct, total, extra, elapsed)):
+                totals[name][i] += value
+            print(f"  {name:8s} segments {found}/{len(expected)}  fields {correct}/{total}"
+                  f"  extra {extra}  {elapsed * 1000:7.1f} ms")
+
+        if 'ai' in results:
+            same, compared = agreement(results['offline'], results['ai'])
+            agree_total[0] += same
+            agree_total[1] += compared
+            print(f"  offline/ai agreement {same}/{compared}")
+
+    print("total")
+    for name, (found, correct, total, extra, elapsed) in totals.items():
+        accuracy = correct / total * 100 if total else 0
+        print(f"  {name:8s} field accuracy {accuracy:5.1f}%  extra segments {extra}  {elapsed * 1000:7.1f} ms")
+    if agree_total[1]:
+        print(f"  offline/ai agreement {agree_total[0] / agree_total[1] * 100:5.1f}%")
+    if args.fixtures == DEFAULT_FIXTURES:
+        print("note: the bundled fixtures are synthetic guides built alongside the extractor; "
+              "these scores catch regressions and say little about real partner guide layouts")
+
+
+if __name__ == '__main__':
+    main()
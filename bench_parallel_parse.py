@@ -0,0 +1,77 @@
+"""Parallel EDI-to-JSON conversion: time per worker count on a generated interchange
+
+Each worker count runs in a fresh interpreter with PARALLEL_PARSE_WORKERS set,
+and is compared against the single-process convert_edi_to_json plus json.dumps.
+
+Usage: python bench_parallel_parse.py [--transactions 5000] [--workers 1 2 4 8]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+RUN_SNIPPET = """
+import json, os, sys, time
+from app import convert_edi_to_json, convert_edi_to_json_text
+from bench_parallel_parse import make_interchange
+
+if __name__ == '__main__':
+    edi_data = make_interchange(int(sys.argv[1]))
+    # Send the parser's per-segment output, including the pool workers', to /dev/null
+    result = os.fdopen(os.dup(1), 'w')
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    if sys.argv[2] == 'sequential':
+        started = time.perf_counter()
+        json.dumps(convert_edi_to_json(edi_data))
+    else:
+        convert_edi_to_json_text(edi_data[:10000])  # start the pool
+        started = time.perf_counter()
+        convert_edi_to_json_text(edi_data)
+    print(time.perf_counter() - started, file=result)
+    result.flush()
+"""
+
+
+def make_interchange(transactions, lines=20):
+    """Build one interchange with the given number of 855 transactions"""
+    segments = ["ISA*00*          *00*          *ZZ*SENDER         *ZZ*RECEIVER       "
+                "*240101*1200*U*00401*000000001*0*P*>~",
+                "GS*PR*SENDER*RECEIVER*20240101*1200*1*X*004010~"]
+    for number in range(transactions):
+        segments.append(f"ST*855*{number:04d}~")
+        segments.append(f"BAK*00*AD*PO{number}*20240101~")
+        for line in range(1, lines + 1):
+            segments.append(f"PO1*{line}*{line + 1}*EA*{line}.50**BP*ITEM{line}~")
+            segments.append(f"ACK*IA*{line + 1}*EA*068*20240102~")
+        segments.append(f"CTT*{lines}~")
+        segments.append(f"SE*{lines * 2 + 4}*{number:04d}~")
+    segments += ["GE*1*1~", "IEA*1*000000001~"]
+    return "\n".join(segments)
+
+
+def run(transactions, mode, workers=1):
+    env = dict(os.environ, PARALLEL_PARSE_WORKERS=str(workers))
+    output = subprocess.run([sys.executable, '-c', RUN_SNIPPET, str(transactions), mode],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--transactions', type=int, default=5000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1])
+    args = parser.parse_args()
+
+    size = len(make_interchange(args.transactions)) / 1024 / 1024
+    print(f"interchange: {args.transactions} transactions, {size:.1f} MiB, {os.cpu_count()} cpus")
+    sequential = run(args.transactions, 'sequential')
+    print(f"sequential:       {sequential:7.2f} s")
+    for workers in sorted(set(args.workers)):
+        elapsed = run(args.transactions, 'parallel', workers)
+        print(f"{workers:2d} workers:       {elapsed:7.2f} s  speedup {sequential / elapsed:4.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Startup benchmark: import time, time-to-first-request and per-worker memory
+
+Usage: python bench_startup.py [--runs 5] [--workers 4]
+"""
+import argparse
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_SNIPPET = """
+import time
+started = time.perf_counter()
+import app
+print(time.perf_counter() - started)
+"""
+
+FIRST_REQUEST_SNIPPET = """
+import time
+started = time.perf_counter()
+from app import create_app
+client = create_app().test_client()
+client.get('/api/sample-edi-json')
+print(time.perf_counter() - started)
+"""
+
+
+def run_snippet(snippet, runs):
+    """Run a snippet in fresh interpreters and return the median of its printed timings"""
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', snippet], cwd=ROOT, capture_output=True, text=True, check=True)
+        timings.append(float(output.stdout.strip().splitlines()[-1]))
+    return statistics.median(timings)
+
+
+def read_memory(pid):
+    """Return RSS and PSS in KiB for a process from /proc"""
+    memory = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss'):
+                memory[key.lower()] = int(value.split()[0])
+    return memory
+
+
+def child_pids(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure_workers(workers):
+    """Start gunicorn with the repo configuration and report per-worker memory"""
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = time.time() + 30
+        while len(child_pids(server.pid)) < workers or not _responds(port):
+            if time.time() > deadline:
+                raise RuntimeError('gunicorn did not start within 30 seconds')
+            time.sleep(0.1)
+        # Touch every worker once so the numbers include a served request
+        for _ in range(workers * 2):
+            _responds(port)
+        return read_memory(server.pid), [read_memory(pid) for pid in child_pids(server.pid)]
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+
+def _responds(port):
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/api/sample-edi-json', timeout=2) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"import app:             {run_snippet(IMPORT_SNIPPET, args.runs) * 1000:8.1f} ms")
+    print(f"time to first request:  {run_snippet(FIRST_REQUEST_SNIPPET, args.runs) * 1000:8.1f} ms")
+
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        print("per-worker memory:      skipped (requires Linux /proc)")
+        return
+
+    master, workers = measure_workers(args.workers)
+    print(f"master:                 rss {master['rss'] / 1024:7.1f} MiB  pss {master['pss'] / 1024:7.1f} MiB")
+    for i, worker in enumerate(workers, 1):
+        print(f"worker {i}:               rss {worker['rss'] / 1024:7.1f} MiB  pss {worker['pss'] / 1024:7.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+# Gunicorn configuration: gunicorn -c gunicorn.conf.py
+import multiprocessing
+import os
+
+wsgi_app = "run:app"
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# The app splits its local AI rate limit fallback across this many workers
+os.environ['WEB_CONCURRENCY'] = str(workers)
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+# Load the app once in the master so workers share its memory copy-on-write
+preload_app = True
+
+
+def when_ready(server):
+    # Called in the master after the app is preloaded and before workers fork
+    from app import prepare_for_fork
+    prepare_for_fork()
@@ -0,0 +1,82 @@
+import pytest
+
+import app
+from bench_parallel_parse import make_interchange
+
+
+def interchange(control_number, transactions=2):
+    """A generated interchange with the given ISA13 control number"""
+    return make_interchange(transactions, lines=2).replace('*000000001*', f'*{control_number}*')
+
+
+@pytest.fixture
+def index(tmp_path):
+    return app.InterchangeIndex(path=str(tmp_path / 'index' / 'interchanges.sqlite3'), limit=3)
+
+
+def test_first_sighting_then_duplicate(index):
+    edi_data = interchange('000000001')
+    identity = app.interchange_identity(edi_data)
+    assert index.lookup(identity) == (None, False)
+    
+    index.record(identity, app.analyze_edi(edi_data))
+    entry, reused = index.lookup(identity)
+    assert not reused
+    assert entry["times_seen"] == 2
+    assert entry["analysis"]["segment_counts"] == app.analyze_edi(edi_data)["segment_counts"]
+
+
+def test_stored_analysis_leaves_out_elements(index):
+    edi_data = interchange('000000001')
+    identity = app.interchange_identity(edi_data)
+    analysis = app.analyze_edi(edi_data)
+    index.record(identity, analysis)
+    stored = index.lookup(identity)[0]["analysis"]
+    assert "elements" not in stored
+    assert list(stored["line_item_columns"]["po1_quantity"]) == list(analysis["line_item_columns"]["po1_quantity"])
+
+
+def test_control_number_reused_with_different_content(index):
+    first = interchange('000000007', transactions=2)
+    index.record(app.interchange_identity(first))
+    assert index.lookup(app.interchange_identity(interchange('000000007', transactions=3))) == (None, True)
+    assert index.lookup(app.interchange_identity(interchange('000000008', transactions=3))) == (None, False)
+
+
+def test_evicts_oldest_past_limit(index):
+    identities = [app.interchange_identity(interchange(f'00000001{number}')) for number in range(4)]
+    for identity in identities:
+        index.record(identity)
+    assert index.lookup(identities[0])[0] is None
+    assert all(index.lookup(identity)[0] is not None for identity in identities[1:])
+
+
+def test_drops_oldest_results_past_max_bytes(tmp_path):
+    edi_data = [interchange(f'00000002{number}') for number in range(3)]
+    blob_size = len(app.dump_analysis(app.analyze_edi(edi_data[0])))
+    index = app.InterchangeIndex(path=str(tmp_path / 'interchanges.sqlite3'), max_bytes=blob_size * 2 + 100)
+    identities = [app.interchange_identity(data) for data in edi_data]
+    for data, identity in zip(edi_data, identities):
+        index.record(identity, app.analyze_edi(data))
+    
+    oldest = index.lookup(identities[0])[0]
+    assert oldest is not None and oldest["analysis"] is None
+    assert all(index.lookup(identity)[0]["analysis"] is not None for identity in identities[1:])
+
+
+def test_large_interchange_is_recorded_without_serializing(index, monkeypatch):
+    edi_data = interchange('000000003')
+    identity = app.interchange_identity(edi_data)
+    monkeypatch.setattr(app, 'DUPLICATE_RESULT_MAX_EDI_BYTES', identity["size"] - 1)
+    monkeypatch.setattr(app, 'dump_analysis', lambda analysis: pytest.fail("analysis was serialized"))
+    index.record(identity, app.analyze_edi(edi_data))
+    entry = index.lookup(identity)[0]
+    assert entry is not None and entry["analysis"] is None
+
+
+def test_identity_ignores_surrounding_whitespace():
+    edi_data = interchange('000000004')
+    identity = app.interchange_identity(edi_data)
+    padded = app.interchange_identity(f"\n  {edi_data}\r\n".encode('utf-8'))
+    assert (padded["key"], padded["control_number"]) == (identity["key"], '000000004')
+    assert app.interchange_identity("GS*PR*SENDER*RECEIVER~") is None
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+import app
+from bench_parallel_parse import make_interchange
+
+
+@pytest.fixture
+def parallel_workers(monkeypatch):
+    """Run convert_edi_to_json_text on a two-worker pool, shut down afterwards"""
+    monkeypatch.setattr(app, 'PARALLEL_PARSE_WORKERS', 2)
+    monkeypatch.setattr(app, 'parse_executor', None)
+    yield
+    if app.parse_executor is not None:
+        app.parse_executor.shutdown()
+
+
+def without_parsed_date(result):
+    return {key: value for key, value in result.items() if key != 'parsed_date'}
+
+
+@pytest.mark.parametrize('fields', [None, ['summary', 'line_items'], ['interchange']])
+def test_text_conversion_matches_sequential(parallel_workers, fields):
+    edi_data = make_interchange(40, lines=5)
+    text = app.convert_edi_to_json_text(edi_data, fields)
+    assert without_parsed_date(json.loads(text)) == without_parsed_date(app.convert_edi_to_json(edi_data, fields))
+
+
+def test_text_conversion_matches_sequential_for_bytes_with_crlf(parallel_workers):
+    edi_data = make_interchange(40, lines=5).replace('\n', '\r\n')
+    expected = app.convert_edi_to_json(edi_data)
+    text = app.convert_edi_to_json_text(edi_data.encode('utf-8'))
+    assert without_parsed_date(json.loads(text)) == without_parsed_date(expected)
+
+
+def test_split_at_transactions_cuts_before_st():
+    buf = make_interchange(10, lines=2).encode('utf-8')
+    slices = app.split_at_transactions(buf, 200)
+    assert slices[0][0] == 0 and slices[-1][1] == len(buf)
+    assert all(end == start for (_, end), (start, _) in zip(slices, slices[1:]))
+    assert all(buf[start:start + 3] == b'ST*' for start, _ in slices[1:])
+
+
+@pytest.mark.parametrize('fields, expected', [
+    (None, None),
+    ('', None),
+    ([], None),
+    ('summary, line_items', {'summary', 'line_items'}),
+    (['summary'], {'summary'}),
+])
+def test_parse_fields_param(fields, expected):
+    assert app.parse_fields_param(fields) == expected
+
+
+@pytest.mark.parametrize('fields', [[1], 5, {'summary': True}, 'summary,unknown', ['nope']])
+def test_parse_fields_param_rejects_invalid(fields):
+    with pytest.raises(ValueError):
+        app.parse_fields_param(fields)